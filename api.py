@@ -0,0 +1,177 @@
+"""JSON API over dbc.
+
+Every listing is paginated by ID: ?after=<id> returns the items with
+IDs greater than <id>, up to ?limit=<n> of them, along with the URL of
+the next page. Nested plants and jobs are given as lists of IDs unless
+they are named in ?expand=, and ?fields= picks which fields of each
+item are returned. /api/search autocompletes the names of plants and
+jobs.
+"""
+from functools import partial
+from urllib.parse import urlencode
+
+from flask import Blueprint, abort, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+import dbc
+
+blueprint = Blueprint("api", __name__, url_prefix="/api")
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+MAX_SEARCH_LIMIT = 50
+
+
+@blueprint.errorhandler(HTTPException)
+def error(exc):
+    """Report errors as JSON rather than HTML."""
+    return jsonify(error=exc.name, description=exc.description), exc.code
+
+
+def job_dict(job):
+    """Convert a Maintenance object to a dictionary for JSON."""
+    return {"id": job.id, "name": job.name, "description": job.description, "months": job.months}
+
+
+def plant_dict(plant, depth):
+    """Convert a Plant object loaded to the given depth to a dictionary for JSON.
+
+    The months are only included when the jobs have been loaded.
+    """
+    result = {"id": plant.id, "name": plant.name, "latin_name": plant.latin_name,
+              "blooming_period": plant.blooming_period}
+    if depth > 0:
+        result["jobs"] = [job_dict(job) for job in plant.jobs]
+        result["months"] = plant.months
+    else:
+        result["jobs"] = plant.mids
+    return result
+
+
+def client_dict(client, depth):
+    """Convert a Client object loaded to the given depth to a dictionary for JSON."""
+    if depth > 0:
+        plants = [plant_dict(plant, depth - 1) for plant in client.plants]
+    else:
+        plants = client.pids
+    return {"id": client.id, "name": client.name, "plants": plants}
+
+
+def expansions(allowed):
+    """Return the set of nested collections named in ?expand=, rejecting unknown ones."""
+    expand = {name for name in request.args.get("expand", "").split(",") if name}
+    if not expand <= allowed:
+        abort(400, "can only expand {}".format(", ".join(sorted(allowed)) or "nothing"))
+    return expand
+
+
+def project(item):
+    """Keep only the fields of an item named in ?fields=, if given."""
+    fields = [name for name in request.args.get("fields", "").split(",") if name]
+    if not fields:
+        return item
+    unknown = set(fields) - set(item)
+    if unknown:
+        abort(400, "unknown fields: {}".format(", ".join(sorted(unknown))))
+    return {name: item[name] for name in fields}
+
+
+def page(load, convert):
+    """Respond with one keyset-paginated page of items.
+
+    load(after, limit) returns the model objects for the page, and
+    convert turns each of them into a dictionary. The URL of the next
+    page is this request's, with the same query parameters apart from
+    after and limit.
+    """
+    after = request.args.get("after", 0, type=int)
+    limit = min(max(request.args.get("limit", DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+    items = load(after, limit)
+    next_url = None
+    if len(items) == limit:
+        args = request.args.copy()
+        args["after"], args["limit"] = items[-1].id, limit
+        next_url = "{}{}?{}".format(request.script_root, request.path, urlencode(list(args.items(multi=True))))
+    return jsonify(items=[project(convert(item)) for item in items], next=next_url)
+
+
+def single(items, convert):
+    """Respond with the one item loaded, or 404 if there isn't one."""
+    if not items:
+        abort(404)
+    return jsonify(project(convert(items[0])))
+
+
+def client_depth():
+    expand = expansions({"plants", "jobs"})
+    return 2 if "jobs" in expand else 1 if "plants" in expand else 0
+
+
+def plant_depth():
+    return 1 if "jobs" in expansions({"jobs"}) else 0
+
+
+@blueprint.route("/clients")
+def clients():
+    """List clients. ?expand=plants includes their plants, ?expand=jobs their plants' jobs too."""
+    depth = client_depth()
+    with dbc.DBConnection() as c:
+        return page(lambda after, limit: dbc.GraphLoader(c).clients_page(after, limit, depth),
+                    partial(client_dict, depth=depth))
+
+
+@blueprint.route("/clients/<int:cid>")
+def client(cid):
+    """Return one client, with the same options as clients()."""
+    depth = client_depth()
+    with dbc.DBConnection() as c:
+        return single(dbc.GraphLoader(c).clients(cid, depth), partial(client_dict, depth=depth))
+
+
+@blueprint.route("/plants")
+def plants():
+    """List plants. ?expand=jobs includes their jobs and months."""
+    depth = plant_depth()
+    with dbc.DBConnection() as c:
+        return page(lambda after, limit: dbc.GraphLoader(c).plants_page(after, limit, depth),
+                    partial(plant_dict, depth=depth))
+
+
+@blueprint.route("/plants/<int:pid>")
+def plant(pid):
+    """Return one plant, with the same options as plants()."""
+    depth = plant_depth()
+    with dbc.DBConnection() as c:
+        return single(dbc.GraphLoader(c).plants(pid, depth), partial(plant_dict, depth=depth))
+
+
+@blueprint.route("/jobs")
+def jobs():
+    """List maintenance jobs along with their months."""
+    expansions(set())
+    with dbc.DBConnection() as c:
+        return page(dbc.GraphLoader(c).jobs_page, job_dict)
+
+
+@blueprint.route("/jobs/<int:mid>")
+def job(mid):
+    """Return one maintenance job."""
+    expansions(set())
+    with dbc.DBConnection() as c:
+        return single(dbc.GraphLoader(c).jobs(mid), job_dict)
+
+
+@blueprint.route("/search")
+def search():
+    """Autocomplete plants and jobs: the best matches for ?q=, whose last word may be unfinished.
+
+    ?kind=plant or ?kind=job searches only one kind, and ?limit= sets
+    the number of matches (10 by default).
+    """
+    kind = request.args.get("kind")
+    if kind is not None and kind not in dbc.SEARCH_INDEXES:
+        abort(400, "kind must be one of {}".format(", ".join(sorted(dbc.SEARCH_INDEXES))))
+    limit = min(max(request.args.get("limit", 10, type=int), 1), MAX_SEARCH_LIMIT)
+    with dbc.DBConnection() as c:
+        results = c.search(request.args.get("q", ""), [kind] if kind else list(dbc.SEARCH_INDEXES), limit)
+    return jsonify(items=[result._asdict() for result in results])
@@ -1,17 +1,129 @@
+import api
 import dbc
 import os
+from datetime import datetime, timezone
+from functools import wraps
 
-from flask import Flask, render_template, send_from_directory, request, redirect, url_for
+import click
+from flask import (Flask, render_template, send_from_directory, request, redirect, url_for, make_response, abort,
+                   stream_template, stream_with_context)
+from flask.cli import AppGroup
 from flask_sslify import SSLify
 
 import sorting
+from dbc import bulk, ical
 
 app = Flask(__name__)
 sslify = SSLify(app=app, permanent=True)
+dbc.init_app(app)
+app.register_blueprint(api.blueprint)
+garden_cli = AppGroup("garden", help="Manage the garden database.")
+app.cli.add_command(garden_cli)
 
 # A necessary list of all the months.
-months = ["January", "February", "March", "April", "May", "June", "July",
-          "August", "September", "October", "November", "December"]
+months = sorting.MONTHS
+
+
+def conditional_get(view):
+    """Answer GET requests for a listing page conditionally, based on the database version.
+
+    The page is given a strong ETag made from the endpoint and the
+    database's change counter, and a Last-Modified time. If the
+    browser already has the current version, respond with
+    304 Not Modified without running the view or loading any data.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != "GET":
+            return view(*args, **kwargs)
+        with dbc.DBConnection() as c:
+            generation, modified = c.version()
+        etag = "{}-{}".format(request.endpoint, generation)
+        last_modified = datetime.fromtimestamp(modified, timezone.utc)
+        if request.if_none_match.contains(etag) or (
+                not request.if_none_match and request.if_modified_since is not None
+                and request.if_modified_since >= last_modified):
+            response = make_response("", 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+
+def cached_export(kind, cid, mimetype, render):
+    """Answer a request for an export of one client's schedule, from the cache if possible.
+
+    render(client_name, connection) must return an iterable of the
+    export's text, which is streamed to the browser as it is made and
+    then kept in dbc.export_cache. The export is cached, and given an
+    ETag, by the client's version, so it is only made again once the
+    client's schedule has changed, and the browser's copy is checked
+    without loading anything but the version.
+    """
+    with dbc.DBConnection() as c:
+        version = c.client_version(cid)
+        if version is None:
+            abort(404)
+    etag = "{}-{}-{}".format(kind, cid, version)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        key = (dbc.current_database(), kind, cid)
+        body = dbc.export_cache.lookup(key, version) if dbc.export_cache.enabled else None
+        if body is None:
+            # Once the stream has started it can't become a 404, so a
+            # client deleted since its version was read is caught here.
+            with dbc.DBConnection() as c:
+                client = c.select_clients(cid)
+            if not client:
+                abort(404)
+            body = stream_with_context(_store_export(key, version, client[0][1], render))
+        response = app.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def _store_export(key, version, client_name, render):
+    chunks = []
+    with dbc.DBConnection() as c:
+        for chunk in render(client_name, c):
+            chunks.append(chunk)
+            yield chunk
+    if dbc.export_cache.enabled:
+        dbc.export_cache.store(key, version, "".join(chunks))
+
+
+def stream_listing(template, load, **context):
+    """Return a response streaming a listing page to the browser as it is rendered.
+
+    load(connection) must return an iterable of the page's items, which
+    the template gets as data and must only go through once. The page
+    header and navigation are sent before any item has been loaded,
+    and the items are loaded while the page is being sent rather than
+    all at once beforehand. Once the response has started, an error
+    can only cut the page short rather than turn it into an error page.
+    """
+    def items():
+        with dbc.DBConnection() as c:
+            yield from load(c)
+    return app.response_class(buffered(stream_template(template, data=items(), **context)))
+
+
+def buffered(chunks, size=4096):
+    """Join the many small pieces of text a template is rendered in into chunks of at least size characters."""
+    pending, length = [], 0
+    for chunk in chunks:
+        pending.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(pending)
+            pending, length = [], 0
+    if pending:
+        yield "".join(pending)
 
 
 @app.route("/")
@@ -21,15 +133,19 @@ def index():
 
 
 @app.route("/clients", methods=["GET", "POST"])
+@conditional_get
 def clients():
     """Handle requests for the clients page.
 
     If the request is a POST request, execute the action specified by
     the browser in the form.
-    Return clients.html, rendered with the client, plant and month data inserted.
+    Return clients.html, streamed with the client and month data
+    inserted. The schedules themselves are fetched by the page one
+    client and month at a time from client_schedule_fragment(), and
+    plants to add to a client are looked up through the search API.
     """
-    with dbc.DBConnection() as c:
-        if request.method == "POST":
+    if request.method == "POST":
+        with dbc.DBConnection() as c:
             # In the form, the browser may send a list of plant IDs to link. They arrive as form fields
             # with names like 'plant-n' where n is the ID of a plant to link.
             # For every form field, check if the 1st 5 characters are 'plant'. If so, then extract the plant id.
@@ -45,14 +161,59 @@ def clients():
                 client = dbc.Client(request.form["name"], cid=request.form["id"], plants=pids_to_link)
                 client.update()
 
-        return render_template("clients.html", data=c.load_sql_client_data(),
-                               plant_list=c.load_sql_plant_data(), months=months)
+    return stream_listing("clients.html", lambda c: c.iter_sql_client_data(), months=months)
+
+
+@app.route("/clients/<int:cid>/schedule/<int:month>")
+@conditional_get
+def client_schedule_fragment(cid, month):
+    """Return the HTML fragment listing a client's maintenance for one month (1-12)."""
+    if not 1 <= month <= 12:
+        abort(404)
+    with dbc.DBConnection() as c:
+        client = c.select_clients(cid)
+        if not client:
+            abort(404)
+        return render_template("schedule.html", client_name=client[0][1], month=months[month - 1],
+                               entries=c.select_schedule(cid, month))
+
+
+@app.route("/clients/<int:cid>/schedule")
+def client_schedule(cid):
+    """Return a compact printable page of a client's maintenance for the whole year."""
+    return cached_export("print", cid, "text/html", lambda client_name, c: stream_template(
+        "client_schedule.html", title=client_name, client_name=client_name, cid=cid, months=months,
+        schedule=c.schedule_by_month(cid)))
+
+
+@app.route("/clients/<int:cid>/schedule.ics")
+def client_calendar(cid):
+    """Return a client's maintenance for the whole year as an iCalendar file to subscribe to."""
+    return cached_export("ical", cid, "text/calendar", lambda client_name, c: ical.calendar(
+        client_name, c.schedule_by_month(cid)))
+
+
+@app.route("/reports/year", defaults={"month": None})
+@app.route("/reports/month/<int:month>")
+@conditional_get
+def workload_report(month):
+    """Return a report of how many times each job needs doing for each client, in a month (1-12) or the whole year."""
+    if month is not None and not 1 <= month <= 12:
+        abort(404)
+    with dbc.DBConnection() as c:
+        entries = c.workload(month)
+    # In the same order as the entries of each client, with jobs without names first.
+    totals = sorted({entry.mid: entry for entry in entries}.values(),
+                    key=lambda entry: (entry.job is not None, entry.job or ""))
+    title = "Workload - " + (months[month - 1] if month is not None else "whole year")
+    return render_template("report.html", title=title, month=month, months=months, entries=entries, totals=totals)
 
 
 @app.route("/plants", methods=["GET", "POST"])
+@conditional_get
 def plants():
-    with dbc.DBConnection() as c:
-        if request.method == "POST":
+    if request.method == "POST":
+        with dbc.DBConnection() as c:
             mids_to_link = [field[4:] for field in request.form.keys() if field[:3] == "job"]
             if "delete" in request.form:
                 c.drop_plant(request.form["id"])
@@ -69,20 +230,18 @@ def plants():
                                   jobs=mids_to_link)
                 plant.update()
 
-        return render_template("plants.html", data=c.load_sql_plant_data(),
-                               job_list=c.load_sql_job_data())
+    return stream_listing("plants.html", lambda c: c.iter_sql_plant_data())
 
 
 @app.route("/maintenance", methods=["GET", "POST"])
+@conditional_get
 def jobs():
     with dbc.DBConnection() as c:
         if request.method == "POST":
-            # & is the intersection operator. set() converts the dict_keyiterator and list to sets so that the
-            # intersection can be found of them. list() converts this back to a list which is sorted on the
-            # basis that each item in the new list is the name of a month.
+            # Keep the months, in calendar order, that were ticked in the form.
             # A useful side effect of this operation is that any invalid months
             # sent by rogue browsers are filtered out.
-            active_months = sorted(list(set(request.form) & set(months)), key=sorting.dt_from_month)
+            active_months = [month for month in months if month in request.form]
             if "delete" in request.form:
                 c.drop_job(request.form["id"])
 
@@ -108,7 +267,96 @@ def favicon():
                                'favicon.ico', mimetype='image/x-icon')
 
 
+@app.route("/metrics")
+def metrics():
+    """Return the request and SQL metrics in Prometheus' text format, if they are switched on.
+
+    At a tenant's subdomain only that tenant's metrics are shown; those
+    of every tenant are only shown at the address that isn't a tenant's.
+    """
+    if not dbc.metrics.enabled:
+        abort(404)
+    return (dbc.metrics.render(tenant=dbc.current_tenant()), 200,
+            {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+def tenant_option(command):
+    """Add a --tenant option to a command, making it use that tenant's database instead of the default one."""
+    @click.option("--tenant", help="Use this tenant's database rather than the default one.")
+    @wraps(command)
+    def wrapper(tenant, **kwargs):
+        if tenant is None:
+            return command(**kwargs)
+        try:
+            dbname = dbc.tenant_database(tenant)
+        except ValueError as exc:
+            raise click.ClickException(str(exc))
+        if not os.path.exists(dbname):
+            raise click.ClickException("there is no tenant called {}".format(tenant))
+        with dbc.use_database(dbname):
+            return command(**kwargs)
+    return wrapper
+
+
+@garden_cli.command("migrate")
+def migrate():
+    """Bring the schema of the database, and of every tenant's database, up to date."""
+    applied = dbc.migrate()
+    click.echo("Applied {} migration(s); schema is at version {}.".format(applied, dbc.migrations.latest_version()))
+    for tenant in dbc.tenants():
+        applied = dbc.migrate(dbc.tenant_database(tenant))
+        click.echo("Applied {} migration(s) to tenant {}.".format(applied, tenant))
+
+
+@garden_cli.command("add-tenant")
+@click.argument("name")
+def add_tenant(name):
+    """Create the database of a new tenant, served at the subdomain NAME."""
+    try:
+        dbname = dbc.tenant_database(name)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+    if os.path.exists(dbname):
+        raise click.ClickException("tenant {} already exists".format(name))
+    dbc.migrate(dbname)
+    click.echo("Created {}.".format(dbname))
+
+
+@garden_cli.command("import")
+@click.argument("file", type=click.File("r"))
+@click.option("--format", "file_format", type=click.Choice(["jsonl", "csv"]),
+              help="File format; guessed from the file name if not given.")
+@tenant_option
+def import_data(file, file_format):
+    """Import jobs, plants and clients from a JSON Lines or CSV file ('-' for stdin)."""
+    file_format = file_format or ("csv" if file.name.endswith(".csv") else "jsonl")
+    records = bulk.read_csv(file) if file_format == "csv" else bulk.read_jsonl(file)
+    with dbc.DBConnection() as c:
+        try:
+            counts = bulk.import_records(c, records)
+        except ValueError as exc:
+            raise click.ClickException(str(exc))
+    click.echo("Imported {job} new job(s), {plant} plant(s) and {client} client(s), and {links} link(s).".format(**counts))
+
+
+@garden_cli.command("export")
+@click.argument("file", type=click.File("w"), default="-")
+@click.option("--format", "file_format", type=click.Choice(["jsonl", "csv"]),
+              help="File format; guessed from the file name if not given.")
+@tenant_option
+def export_data(file, file_format):
+    """Export all jobs, plants and clients to a JSON Lines or CSV file (stdout by default)."""
+    file_format = file_format or ("csv" if file.name.endswith(".csv") else "jsonl")
+    with dbc.DBConnection() as c:
+        records = bulk.export_records(c)
+        if file_format == "csv":
+            bulk.write_csv(records, file)
+        else:
+            bulk.write_jsonl(records, file)
+
+
 if __name__ == "__main__":
+    dbc.migrate()
     context = ('server.crt', 'server.key')
     app.secret_key = "Ye to misery wisdom plenty polite to as."
     app.run(host='0.0.0.0', port=443, debug=False, ssl_context=context)
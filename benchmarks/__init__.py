@@ -0,0 +1,6 @@
+"""Benchmarks for the garden database.
+
+Each module can be run with 'python -m benchmarks.<module>' from the
+top of the repository. They work on a synthetic database built in a
+temporary file by benchmarks.data, never on database.db.
+"""
@@ -0,0 +1,118 @@
+"""A check that writers wait for one another instead of failing with "database is locked".
+
+For each configuration of SQLite settings asked for, another connection
+holds the database's write lock for --hold seconds while each write
+operation of dbc is run, once on a freshly opened pooled connection
+and once on one that has been used already. Every operation should
+wait for the lock, within the busy timeout, and then succeed. Unlike
+benchmarks.load, the default configurations don't queue writes up
+behind a WriterLock, so the waiting is all SQLite's:
+
+    python -m benchmarks.contention [--hold SECONDS] [--config NAME ...]
+"""
+import argparse
+import sqlite3 as sql
+import threading
+import time
+
+import dbc
+from benchmarks import data, load
+
+# The write operations to check, each a function of a number that differs from run to run.
+WRITES = [
+    ("Client.insert", lambda n: dbc.Client("Contended {}".format(n), plants=[1, 2]).insert()),
+    ("Client.update", lambda n: dbc.Client("Contended {}".format(n), cid=1, plants=[1, n % 5 + 2]).update()),
+    ("Plant.insert", lambda n: dbc.Plant("Contended {}".format(n), "Latin", "May", jobs=[1]).insert()),
+    ("Plant.update", lambda n: dbc.Plant("Contended {}".format(n), "Latin", "May", pid=1,
+                                         jobs=[1, n % 5 + 2]).update()),
+    ("Maintenance.insert", lambda n: dbc.Maintenance("Contended {}".format(n), "Description", [1, 2]).insert()),
+    ("Maintenance.update", lambda n: dbc.Maintenance("Contended {}".format(n), "Description", [n % 12 + 1],
+                                                     mid=1).update()),
+    ("drop_client", lambda n: _with_connection(lambda c: c.drop_client(n))),
+    ("relink_plants_to_client", lambda n: _with_connection(lambda c: c.relink_plants_to_client(1, [1, 2, n % 5 + 3]))),
+    ("relink_jobs_to_plant", lambda n: _with_connection(lambda c: c.relink_jobs_to_plant(1, [1, n % 5 + 2]))),
+    ("relink_months_to_job", lambda n: _with_connection(lambda c: c.relink_months_to_job(1, [n % 12 + 1]))),
+    ("UPDATE jobs", lambda n: _with_connection(
+        lambda c: c.execute("UPDATE jobs SET description=? WHERE mid=1", ("Contended {}".format(n),)))),
+]
+
+# Only settings where SQLite itself has to make writers wait.
+CONFIGS = {name: dict(load.CONFIGS[name], BUSY_TIMEOUT=5.0) for name in ("rollback", "wal")}
+
+
+def _with_connection(write):
+    with dbc.DBConnection() as c:
+        write(c)
+
+
+def contended(dbname, write, hold):
+    """Run write() while another connection holds the write lock for hold seconds.
+
+    Return the seconds write() took, or raise whatever it raised.
+    """
+    locked, done = threading.Event(), threading.Event()
+
+    def hold_lock():
+        con = sql.connect(dbname, timeout=dbc.BUSY_TIMEOUT)
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            locked.set()
+            done.wait(hold)
+            con.rollback()
+        finally:
+            con.close()
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    try:
+        locked.wait()
+        start = time.perf_counter()
+        write()
+        return time.perf_counter() - start
+    finally:
+        done.set()
+        holder.join()
+
+
+def check(settings, hold):
+    """Run every write of WRITES under contention; return a list of (name, fresh, seconds or error) results."""
+    load.configure(settings)
+    results = []
+    with data.dataset(**load.SIZES) as dbname:
+        for n, (name, write) in enumerate(WRITES, 10):
+            for fresh in (True, False):
+                if fresh:
+                    dbc.close_database(dbname)
+                try:
+                    outcome = contended(dbname, lambda: write(n + fresh), hold)
+                except sql.Error as exc:
+                    outcome = exc
+                results.append((name, fresh, outcome))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hold", type=float, default=0.5, help="seconds the other connection holds the lock")
+    parser.add_argument("--config", choices=sorted(CONFIGS), action="append",
+                        help="configuration to check (repeatable; default: all)")
+    args = parser.parse_args(argv)
+
+    saved = {name: getattr(dbc, name) for name in load.CONFIGS["rollback"]}
+    failed = False
+    print("{:<10} {:<24} {:<11} {}".format("config", "write", "connection", "result"))
+    try:
+        for config in args.config or CONFIGS:
+            for name, fresh, outcome in check(CONFIGS[config], args.hold):
+                if isinstance(outcome, Exception):
+                    result, failed = "failed: {}".format(outcome), True
+                else:
+                    result = "waited {:.0f}ms".format(outcome * 1000)
+                print("{:<10} {:<24} {:<11} {}".format(config, name, "fresh" if fresh else "used", result))
+    finally:
+        load.configure(saved)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
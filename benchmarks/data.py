@@ -0,0 +1,67 @@
+"""Synthetic garden databases of any size, for benchmarking."""
+import os
+import random
+import tempfile
+from contextlib import contextmanager
+
+import dbc
+import sorting
+from dbc import bulk
+
+# The default size of a synthetic database.
+SIZES = {"clients": 300, "plants": 200, "jobs": 40,
+         "plants_per_client": 20, "jobs_per_plant": 4, "months_per_job": 3}
+
+
+def records(clients, plants, jobs, plants_per_client, jobs_per_plant, months_per_job, seed=0):
+    """Yield bulk import records for a random but repeatable garden.
+
+    Every client owns plants_per_client plants, every plant needs
+    jobs_per_plant jobs and every job is done in months_per_job months,
+    chosen at random, so popular plants end up shared by many clients.
+    """
+    rng = random.Random(seed)
+    job_names = ["Job {}".format(n) for n in range(1, jobs + 1)]
+    plant_names = ["Plant {}".format(n) for n in range(1, plants + 1)]
+    for name in job_names:
+        yield {"kind": "job", "name": name, "description": "Description of " + name.lower(),
+               "months": rng.sample(sorting.MONTHS, min(months_per_job, 12))}
+    for name in plant_names:
+        yield {"kind": "plant", "name": name, "latin_name": "Planta " + name.split()[1],
+               "blooming_period": rng.choice(sorting.MONTHS),
+               "jobs": rng.sample(job_names, min(jobs_per_plant, jobs))}
+    for n in range(1, clients + 1):
+        yield {"kind": "client", "name": "Client {}".format(n),
+               "plants": rng.sample(plant_names, min(plants_per_client, plants))}
+
+
+def build(path, seed=0, **sizes):
+    """Create a database file at path filled with records(), and return the import counts."""
+    dbc.migrate(path)
+    dbname, dbc.DATABASE = dbc.DATABASE, path
+    try:
+        with dbc.DBConnection() as c:
+            return bulk.import_records(c, records(seed=seed, **dict(SIZES, **sizes)))
+    finally:
+        dbc.DATABASE = dbname
+
+
+@contextmanager
+def dataset(seed=0, **sizes):
+    """Build a synthetic database in a temporary file and make it the default database.
+
+    dbc.DATABASE points at the file for the duration of the 'with'
+    block, and the file is deleted afterwards.
+    """
+    directory = tempfile.mkdtemp(prefix="garden-bench-")
+    path = os.path.join(directory, "bench.db")
+    build(path, seed=seed, **sizes)
+    dbname, dbc.DATABASE = dbc.DATABASE, path
+    try:
+        yield path
+    finally:
+        dbc.DATABASE = dbname
+        dbc.close_database(path)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
@@ -0,0 +1,190 @@
+"""A load test of several worker processes reading and writing one database at once.
+
+Each worker is a separate process, like a gunicorn worker, sending a
+random mix of page, fragment and API reads and client and job writes
+through Flask's test client for a fixed time. The test is run once for
+each configuration of SQLite settings asked for, on a fresh synthetic
+database each time, and reports the throughput, latencies and any
+errors, such as "database is locked":
+
+    python -m benchmarks.load [--workers N] [--duration SECONDS] [--write-ratio R] [--config NAME ...]
+
+--busy-timeout overrides the busy timeout of every configuration.
+With --busy-timeout 0 nothing waits for a lock, so every conflict
+between workers shows up as an error rather than as a wait.
+"""
+import argparse
+import multiprocessing
+import random
+import sqlite3 as sql
+import time
+from collections import Counter
+
+import dbc
+import sorting
+from benchmarks import data
+
+# The configurations to compare, as values for dbc's SQLite settings.
+CONFIGS = {
+    "rollback": {"JOURNAL_MODE": None, "SYNCHRONOUS": None, "BUSY_TIMEOUT": 5.0, "SINGLE_WRITER": False,
+                 "IN_MEMORY": False},
+    "wal": {"JOURNAL_MODE": "wal", "SYNCHRONOUS": "normal", "BUSY_TIMEOUT": 5.0, "SINGLE_WRITER": False,
+            "IN_MEMORY": False},
+    "production": {"JOURNAL_MODE": "wal", "SYNCHRONOUS": "normal", "BUSY_TIMEOUT": 10.0, "SINGLE_WRITER": True,
+                   "IN_MEMORY": False},
+    "memory": {"JOURNAL_MODE": "wal", "SYNCHRONOUS": "normal", "BUSY_TIMEOUT": 10.0, "SINGLE_WRITER": True,
+               "IN_MEMORY": True},
+}
+
+# A smaller garden than the default, so that each request is quick and requests overlap a lot.
+SIZES = dict(data.SIZES, clients=100, plants_per_client=10)
+
+
+def configure(settings):
+    for name, value in settings.items():
+        setattr(dbc, name, value)
+
+
+class Worker:
+    """Sends random requests to the app as fast as it can and records how they went.
+
+    The requests go to base_url, and the names the worker writes start
+    with tag, so that they can be told apart from other workers' writes.
+    """
+
+    def __init__(self, seed, write_ratio, base_url="https://localhost", tag=""):
+        import app
+        app.app.testing = True
+        self.client = app.app.test_client()
+        self.rng = random.Random(seed)
+        self.write_ratio = write_ratio
+        self.base_url = base_url
+        self.tag = tag
+        with dbc.DBConnection() as c:
+            self.cids = [row[0] for row in c.select_clients()]
+            self.pids = [row[0] for row in c.select_plants()]
+            self.mids = [row[0] for row in c.select_jobs()]
+        self.latencies = {"read": [], "write": []}
+        self.errors = Counter()
+
+    def run(self, duration):
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            self.step()
+
+    def step(self):
+        """Send one random request and record its latency or error."""
+        kind = "write" if self.rng.random() < self.write_ratio else "read"
+        start = time.perf_counter()
+        try:
+            status = self.write() if kind == "write" else self.read()
+        except sql.Error as exc:
+            self.errors[str(exc)] += 1
+            return
+        if status >= 400:
+            self.errors["HTTP {}".format(status)] += 1
+            return
+        self.latencies[kind].append(time.perf_counter() - start)
+
+    def read(self):
+        url = self.rng.choice([
+            "/plants",
+            "/maintenance",
+            "/api/clients?expand=plants&limit=50",
+            "/clients/{}/schedule/{}".format(self.rng.choice(self.cids), self.rng.randint(1, 12)),
+        ])
+        return self.finish(self.client.get(url, base_url=self.base_url))
+
+    def write(self):
+        choice = self.rng.random()
+        if choice < 0.5:
+            form = {"edit": "", "id": self.rng.choice(self.cids),
+                    "name": "Client {}{}".format(self.tag, self.rng.random())}
+            form.update(("plant-{}".format(pid), "on") for pid in self.rng.sample(self.pids, 10))
+            url = "/clients"
+        else:
+            form = {"edit": "", "id": self.rng.choice(self.mids),
+                    "name": "Job {}{}".format(self.tag, self.rng.random()), "desc": "Description"}
+            form.update((month, "on") for month in self.rng.sample(sorting.MONTHS, 3))
+            url = "/maintenance"
+        return self.finish(self.client.post(url, data=form, base_url=self.base_url))
+
+    @staticmethod
+    def finish(response):
+        """Read the whole of a response, as a browser would, and return its status code."""
+        response.get_data()
+        return response.status_code
+
+
+def work(dbname, settings, duration, write_ratio, seed, results):
+    """The body of a worker process: run a Worker and put its latencies and errors on a queue."""
+    try:
+        configure(settings)
+        dbc.DATABASE = dbname
+        worker = Worker(seed, write_ratio)
+        worker.run(duration)
+        results.put((worker.latencies, dict(worker.errors)))
+    except Exception as exc:
+        results.put(({"read": [], "write": []}, {"worker failed: {}".format(exc): 1}))
+
+
+def load_test(settings, workers, duration, write_ratio):
+    """Run the workers against a fresh database with the given settings and return the combined results."""
+    configure(settings)
+    context = multiprocessing.get_context("spawn")
+    with data.dataset(**SIZES) as dbname:
+        results = context.Queue()
+        processes = [context.Process(target=work, args=(dbname, settings, duration, write_ratio, seed, results))
+                     for seed in range(workers)]
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    latencies = {"read": [], "write": []}
+    errors = Counter()
+    for worker_latencies, worker_errors in outcomes:
+        for kind, values in worker_latencies.items():
+            latencies[kind].extend(values)
+        errors.update(worker_errors)
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10, help="seconds each configuration runs for")
+    parser.add_argument("--write-ratio", type=float, default=0.2, help="fraction of requests that write")
+    parser.add_argument("--config", choices=sorted(CONFIGS), action="append",
+                        help="configuration to test (repeatable; default: all)")
+    parser.add_argument("--busy-timeout", type=float, help="busy timeout in seconds for every configuration")
+    args = parser.parse_args(argv)
+
+    failed = False
+    print("{:<12} {:>8} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "config", "reads/s", "writes/s", "errors", "read p50", "read p99", "write p50", "write p99"))
+    for name in args.config or CONFIGS:
+        settings = dict(CONFIGS[name])
+        if args.busy_timeout is not None:
+            settings["BUSY_TIMEOUT"] = args.busy_timeout
+        latencies, errors = load_test(settings, args.workers, args.duration, args.write_ratio)
+        print("{:<12} {:>8.1f} {:>8.1f} {:>8} {:>8.1f}ms {:>8.1f}ms {:>8.1f}ms {:>8.1f}ms".format(
+            name, len(latencies["read"]) / args.duration, len(latencies["write"]) / args.duration,
+            sum(errors.values()),
+            percentile(latencies["read"], 0.5) * 1000, percentile(latencies["read"], 0.99) * 1000,
+            percentile(latencies["write"], 0.5) * 1000, percentile(latencies["write"], 0.99) * 1000))
+        for message, count in errors.most_common():
+            print("    {} x {}".format(count, message))
+        failed = failed or bool(errors)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,46 @@
+"""Memory used by the loaded client -> plant -> job graph.
+
+Loads every client to full depth with the identity map on and off and
+reports the memory the graph holds and how many Plant and Maintenance
+objects make it up, against how many places refer to them:
+
+    python -m benchmarks.memory [--clients N] [--plants-per-client N] ...
+"""
+import argparse
+import gc
+import tracemalloc
+
+import dbc
+from benchmarks import data
+
+
+def measure(identity_map):
+    """Load the whole graph and return (bytes allocated, distinct objects, references to them)."""
+    gc.collect()
+    tracemalloc.start()
+    with dbc.DBConnection() as c:
+        clients = dbc.GraphLoader(c, identity_map=identity_map).clients()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    plants = [plant for client in clients for plant in client.plants]
+    jobs = [job for plant in plants for job in plant.jobs]
+    distinct = len({id(obj) for obj in plants + jobs})
+    return size, distinct, len(plants) + len(jobs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    for name, default in data.SIZES.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=int, default=default)
+    args = parser.parse_args(argv)
+    with data.dataset(**vars(args)):
+        results = {identity_map: measure(identity_map) for identity_map in (False, True)}
+    print("{:<14} {:>12} {:>10} {:>12}".format("identity map", "KiB", "objects", "references"))
+    for identity_map, (size, distinct, references) in results.items():
+        print("{:<14} {:>12.1f} {:>10} {:>12}".format("on" if identity_map else "off", size / 1024,
+                                                      distinct, references))
+    print("Saved {:.0%} of the memory.".format(1 - results[True][0] / results[False][0]))
+
+
+if __name__ == "__main__":
+    main()
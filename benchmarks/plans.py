@@ -0,0 +1,125 @@
+"""Checks that dbc's lookups by ID are index searches rather than table scans.
+
+Runs each lookup on a synthetic database, records the statements it
+issues and asks SQLite for their query plans with EXPLAIN QUERY PLAN.
+A lookup fails if any of its statements scans a table (or a whole
+index) instead of searching it, or if none of them searches the index
+that the lookup needs. It also fails if none of its statements were
+recorded, since then nothing has been checked:
+
+    python -m benchmarks.plans
+
+exits with status 1 if any lookup fails.
+"""
+import sys
+
+import dbc
+from benchmarks import data, tracing
+
+# Lookups that must only search indexes, as (description, function of an open DBConnection).
+LOOKUPS = [
+    ("clients owning a plant", lambda c: c.select_pc_links(pid=1)),
+    ("plants of a client", lambda c: c.select_pc_links(cid=1)),
+    ("plants needing a job", lambda c: c.select_jp_links(mid=1)),
+    ("jobs of a plant", lambda c: c.select_jp_links(pid=1)),
+    ("months of a plant", lambda c: c.select_months_of_plant(1)),
+    ("schedule of a client", lambda c: c.select_schedule(cid=1)),
+    ("schedule of a month", lambda c: c.select_schedule(month=1)),
+    ("schedule of a client in a month", lambda c: c.select_schedule(cid=1, month=1)),
+    ("one client", lambda c: dbc.GraphLoader(c).clients(1)),
+    ("one plant", lambda c: dbc.GraphLoader(c).plants(1)),
+    ("relink a client", lambda c: c.relink_plants_to_client(1, [1, 2])),
+    ("drop a client", lambda c: c.drop_client(2)),
+    ("drop a plant", lambda c: c.drop_plant(2)),
+    ("drop a job", lambda c: c.drop_job(2)),
+    ("workload of a month", lambda c: c.workload(1)),
+    ("search", lambda c: c.search("plant 1")),
+    ("version of a client", lambda c: c.client_version(1)),
+    ("relink a job", lambda c: c.relink_months_to_job(1, [1, 2])),
+]
+
+# The index that each of these lookups must search, as the junction tables' primary keys can't answer them.
+INDEXES = {
+    "clients owning a plant": "client_plant_junction_pid",
+    "plants needing a job": "plant_job_junction_mid",
+    "drop a plant": "client_plant_junction_pid",
+    "drop a job": "plant_job_junction_mid",
+}
+
+
+def scans(con, statement):
+    """Return the steps of a statement's query plan that scan rather than search.
+
+    Full-text MATCH queries are reported as scans of the virtual table,
+    but are answered from its index, and scans of subquery results,
+    named or not, only read rows that have already been searched for,
+    so neither counts. Nor does a scan of the one-row generation table,
+    or the statements FTS5 runs on its own tables, which name their
+    schema as 'main'. Scans of every other name count, including the
+    aliases of tables, which the plan shows in place of the table.
+    """
+    if statement.split(None, 1)[0].upper() not in ("SELECT", "UPDATE", "DELETE") or "'main'." in statement:
+        return []
+    plan = [detail for _, _, _, detail in con.execute("EXPLAIN QUERY PLAN " + statement)]
+    # Subqueries in FROM and CTEs show up as MATERIALIZE or CO-ROUTINE steps under their names.
+    subqueries = {detail.split()[1] for detail in plan if detail.startswith(("MATERIALIZE ", "CO-ROUTINE "))}
+    return [detail for detail in plan
+            if detail.startswith("SCAN ") and "VIRTUAL TABLE INDEX" not in detail
+            and detail != "SCAN generation"
+            and not detail.startswith("SCAN (subquery")
+            and detail.split()[1] not in subqueries]
+
+
+def searches(con, statement, index):
+    """Return whether a statement's query plan searches the named index."""
+    if statement.split(None, 1)[0].upper() not in ("SELECT", "UPDATE", "DELETE"):
+        return False
+    return any(detail.startswith("SEARCH ") and "INDEX {} (".format(index) in detail
+               for _, _, _, detail in con.execute("EXPLAIN QUERY PLAN " + statement))
+
+
+def check():
+    """Run every lookup and return a list of (description, [(statement, scans)], index) for the ones that fail.
+
+    index is the name of the index the lookup should have searched but
+    didn't, or None. A lookup whose statements weren't recorded fails
+    with no statements.
+    """
+    failures = []
+    with tracing.traced() as log:
+        for description, lookup in LOOKUPS:
+            log.clear()
+            with dbc.DBConnection() as c:
+                lookup(c)
+                statements = list(log.statements)
+                bad = [(statement, steps) for statement, steps in
+                       ((statement, scans(c.con, statement)) for statement in statements) if steps]
+                index = INDEXES.get(description)
+                if index is not None and any(searches(c.con, statement, index) for statement in statements):
+                    index = None
+            if bad or index or not statements:
+                failures.append((description, bad, index))
+    return failures
+
+
+def report(failures):
+    """Print the results of check() and return whether every lookup passed."""
+    for description, bad, index in failures:
+        print("FAIL {}".format(description))
+        if index:
+            print("    no statement searches {}".format(index))
+        elif not bad:
+            print("    no statements were recorded")
+        for statement, steps in bad:
+            print("    {}\n        {}".format(statement, "\n        ".join(steps)))
+    print("{} of {} lookups use indexes only.".format(len(LOOKUPS) - len(failures), len(LOOKUPS)))
+    return not failures
+
+
+def main():
+    with data.dataset(clients=50, plants=40, jobs=10):
+        sys.exit(0 if report(check()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Serving reads from an in-memory copy of the database (dbc.IN_MEMORY) against reading the file.
+
+First checks that the copy stays consistent with the file: threads
+write clients through the model objects while another process writes
+to the same file, and after every write each thread checks that it can
+read what it wrote and, every few writes, that the process's copy
+holds exactly what the file does. Then times a set of read lookups with
+the copy and without, while the other process keeps writing at the
+given rate. The run fails if that process stops writing early:
+
+    python -m benchmarks.serving [--threads N] [--writes N] [--writes-per-second R] [--reads N]
+"""
+import argparse
+import multiprocessing
+import random
+import threading
+import time
+
+import dbc
+from benchmarks import data
+
+# The read lookups to time, each a function of a DBConnection and a random number generator.
+READS = [
+    ("one client", lambda c, rng: dbc.GraphLoader(c).clients(rng.randint(1, 300))),
+    ("schedule of a client", lambda c, rng: c.select_schedule(cid=rng.randint(1, 300))),
+    ("schedule of a month", lambda c, rng: c.select_schedule(month=rng.randint(1, 12))),
+    ("version of a client", lambda c, rng: c.client_version(rng.randint(1, 300))),
+    ("search", lambda c, rng: c.search("plant {}".format(rng.randint(1, 9)))),
+    ("all clients", lambda c, rng: c.load_sql_client_data()),
+]
+
+
+def background_writes(dbname, rate, stop):
+    """The body of the writer process: redescribe random jobs at about rate writes a second until stop is set."""
+    dbc.DATABASE = dbname
+    rng = random.Random()
+    with dbc.DBConnection() as c:
+        mids = [row[0] for row in c.select_jobs()]
+    while not stop.is_set():
+        with dbc.DBConnection() as c, c.transaction():
+            c.execute("UPDATE jobs SET description=? WHERE mid=?",
+                      ("Background {}".format(rng.random()), rng.choice(mids)))
+        time.sleep(1 / rate)
+
+
+def dump(con):
+    """Return every row of every table of a database, for comparing copies."""
+    tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")]
+    return {table: con.execute("SELECT * FROM \"{}\" ORDER BY 1".format(table)).fetchall() for table in tables}
+
+
+def copy_matches(lease):
+    """Refresh a lease's in-memory copy and return whether it then holds exactly what the file does."""
+    con = lease.con
+    # Hold the write lock meanwhile, so that nothing can be written
+    # between reading the file and copying it.
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        expected = dump(con)
+        # Another thread may be making the copy, in which case the lease
+        # reads the file until it is done.
+        for _ in range(1000):
+            lease.refresh()
+            if lease.reader is not con:
+                return dump(lease.reader) == expected
+            time.sleep(0.001)
+        return False
+    finally:
+        con.rollback()
+
+
+def check_consistency(threads, writes, every=10):
+    """Write and read back clients from several threads; return a list of the inconsistencies found.
+
+    Each thread has clients of its own, so what it reads back should be
+    exactly what it wrote.
+    """
+    problems = []
+
+    def run(seed):
+        try:
+            write_and_check(seed)
+        except Exception as exc:
+            problems.append("thread {}: {!r}".format(seed, exc))
+
+    def write_and_check(seed):
+        rng = random.Random(seed)
+        with dbc.DBConnection() as c:
+            cids = [row[0] for row in c.select_clients()][seed::threads]
+            pids = [row[0] for row in c.select_plants()]
+        for n in range(writes):
+            client = dbc.Client("Thread {} write {}".format(seed, n), cid=rng.choice(cids),
+                                plants=rng.sample(pids, 5))
+            client.update()
+            with dbc.DBConnection() as c:
+                stored = c.select_clients(client.id)
+                links = {plant.id for plant in c.select_pc_links(cid=client.id)}
+                if n % every == 0 and not copy_matches(c.lease):
+                    problems.append("thread {}: the copy differs from the file after write {}".format(seed, n))
+            if stored[0][1] != client.name or links != {int(pid) for pid in client.pids}:
+                problems.append("thread {}: write {} could not be read back".format(seed, n))
+
+    workers = [threading.Thread(target=run, args=(seed,)) for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return problems
+
+
+def time_reads(reads, seed=0):
+    """Run each lookup of READS the given number of times and return their latencies in seconds by name."""
+    rng = random.Random(seed)
+    latencies = {name: [] for name, _ in READS}
+    for _ in range(reads):
+        for name, lookup in READS:
+            start = time.perf_counter()
+            with dbc.DBConnection() as c:
+                lookup(c, rng)
+            latencies[name].append(time.perf_counter() - start)
+    return latencies
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=4, help="threads writing in the consistency check")
+    parser.add_argument("--writes", type=int, default=50, help="writes per thread in the consistency check")
+    parser.add_argument("--writes-per-second", type=float, default=20,
+                        help="rate of the other process's writes (0 for none)")
+    parser.add_argument("--reads", type=int, default=200, help="timed runs of each read lookup")
+    args = parser.parse_args(argv)
+
+    graph_cache_enabled, in_memory = dbc.graph_cache.enabled, dbc.IN_MEMORY
+    dbc.graph_cache.enabled = False
+    context = multiprocessing.get_context("spawn")
+    results, problems = {}, []
+    try:
+        for mode in (False, True):
+            dbc.IN_MEMORY = mode
+            with data.dataset() as dbname:
+                stop = context.Event()
+                writer = None
+                if args.writes_per_second > 0:
+                    writer = context.Process(target=background_writes, args=(dbname, args.writes_per_second, stop))
+                    writer.start()
+                try:
+                    if mode:
+                        problems.extend(check_consistency(args.threads, args.writes))
+                    results[mode] = time_reads(args.reads)
+                finally:
+                    running = writer is not None and writer.is_alive()
+                    stop.set()
+                    if writer is not None:
+                        writer.join()
+                # Timings taken without the writes they are meant to include are no good.
+                if writer is not None and not (running and writer.exitcode == 0):
+                    problems.append("the writing process stopped early, with exit code {}, reading from {}".format(
+                        writer.exitcode, "memory" if mode else "the file"))
+    finally:
+        dbc.graph_cache.enabled, dbc.IN_MEMORY = graph_cache_enabled, in_memory
+
+    print("{:<22} {:>12} {:>12} {:>12} {:>12}".format("lookup", "file p50", "memory p50", "file p99", "memory p99"))
+    for name, _ in READS:
+        print("{:<22} {:>10.3f}ms {:>10.3f}ms {:>10.3f}ms {:>10.3f}ms".format(
+            name, percentile(results[False][name], 0.5) * 1000, percentile(results[True][name], 0.5) * 1000,
+            percentile(results[False][name], 0.99) * 1000, percentile(results[True][name], 0.99) * 1000))
+    print()
+    if problems:
+        print("{} problem(s):".format(len(problems)))
+        for problem in problems:
+            print("    " + problem)
+        return 1
+    print("The in-memory copy was consistent with the file after {} writes.".format(args.threads * args.writes))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
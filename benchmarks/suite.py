@@ -0,0 +1,236 @@
+"""The benchmark suite: dbc's loaders, the model objects' writes and the page routes.
+
+Builds a synthetic database of the requested size, then times each
+operation over a number of runs and, in one further run, counts the
+SQL statements it issues and measures its peak Python memory use:
+
+    python -m benchmarks.suite [--clients N] ... [--repeat N] [--save FILE] [--compare FILE]
+
+--save writes the results to a JSON file, and --compare prints them
+alongside the results saved by an earlier run. The loaded-data and
+export caches are switched off unless --cache is given, so that the
+loaders are measured rather than the caches; "GET /clients (caching)"
+measures the streamed page filling an empty cache either way, against
+"GET /clients (streamed)". --metrics switches on dbc's request metrics
+to measure what they cost. The index checks of benchmarks.plans are
+run too.
+"""
+import argparse
+import itertools
+import json
+import random
+import time
+import tracemalloc
+
+import dbc
+import sorting
+from benchmarks import data, plans, tracing
+
+
+class Workload:
+    """The operations to measure, each a function of no arguments doing the operation once.
+
+    Inserted clients, plants and jobs are remembered so that the drop
+    operations have rows of their own to delete, so every insert
+    operation must be run at least as many times as its drop.
+    """
+
+    def __init__(self, sizes, seed=0):
+        self.sizes = sizes
+        self.rng = random.Random(seed)
+        self.names = itertools.count(1)
+        with dbc.DBConnection() as c:
+            self.cids = [row[0] for row in c.iterate("SELECT cid FROM clients ORDER BY cid")]
+            self.pids = [row[0] for row in c.iterate("SELECT pid FROM plants ORDER BY pid")]
+            self.mids = [row[0] for row in c.iterate("SELECT mid FROM jobs ORDER BY mid")]
+        self.inserted = {"client": [], "plant": [], "job": []}
+        self.client = None
+
+    def operations(self):
+        """Return a list of (name, function) in the order they should be run."""
+        return [
+            ("load_sql_client_data", self.load("load_sql_client_data")),
+            ("load_sql_plant_data", self.load("load_sql_plant_data")),
+            ("load_sql_job_data", self.load("load_sql_job_data")),
+            ("Client.insert", lambda: self.insert("client", self.new_client())),
+            ("Client.update", lambda: self.new_client(self.rng.choice(self.cids)).update()),
+            ("drop_client", lambda: self.drop("client", "drop_client")),
+            ("Plant.insert", lambda: self.insert("plant", self.new_plant())),
+            ("Plant.update", lambda: self.new_plant(self.rng.choice(self.pids)).update()),
+            ("drop_plant", lambda: self.drop("plant", "drop_plant")),
+            ("Maintenance.insert", lambda: self.insert("job", self.new_job())),
+            ("Maintenance.update", lambda: self.new_job(self.rng.choice(self.mids)).update()),
+            ("drop_job", lambda: self.drop("job", "drop_job")),
+            ("GET /clients", self.get("/clients")),
+            ("GET /clients (first)", self.get("/clients", first_chunk=True)),
+            ("GET /clients (streamed)", self.get("/clients", streamed=True)),
+            ("GET /clients (caching)", self.get("/clients", streamed=True, caching=True)),
+            ("GET /plants", self.get("/plants")),
+            ("GET /maintenance", self.get("/maintenance")),
+            ("workload (month)", lambda: self.workload(self.rng.randint(1, 12))),
+            ("workload (year)", lambda: self.workload(None)),
+            ("search", self.search),
+            ("GET /api/search", self.get("/api/search?q=plant+1")),
+            ("GET schedule.ics", self.get("/clients/{}/schedule.ics".format(self.cids[0]))),
+            ("GET schedule (print)", self.get("/clients/{}/schedule".format(self.cids[0]))),
+        ]
+
+    @staticmethod
+    def load(method):
+        def operation():
+            with dbc.DBConnection() as c:
+                getattr(c, method)()
+        return operation
+
+    def get(self, url, first_chunk=False, streamed=False, caching=False):
+        """Return an operation requesting a page, reading all of it or, for streamed pages, only its first chunk.
+
+        With streamed, the chunks of a streamed page are read and thrown
+        away one at a time, as a server would send them, so that the
+        peak memory is that of making the page rather than of holding
+        all of it. With caching, the page is requested with graph_cache
+        switched on but empty, so that what it loads is cached as it goes.
+        """
+        if self.client is None:
+            import app
+            self.client = app.app.test_client()
+
+        def operation():
+            enabled = dbc.graph_cache.enabled
+            if caching:
+                dbc.graph_cache.enabled = True
+                dbc.graph_cache.invalidate()
+            try:
+                response = self.client.get(url, base_url="https://localhost", buffered=not (first_chunk or streamed))
+                assert response.status_code == 200, (url, response.status_code)
+                if first_chunk:
+                    next(iter(response.response))
+                    response.close()
+                elif streamed:
+                    for _ in response.response:
+                        pass
+                    response.close()
+                else:
+                    response.get_data()
+            finally:
+                dbc.graph_cache.enabled = enabled
+        return operation
+
+    @staticmethod
+    def workload(month):
+        with dbc.DBConnection() as c:
+            c.workload(month)
+
+    def search(self):
+        with dbc.DBConnection() as c:
+            c.search("plant {}".format(self.rng.randint(1, 9)))
+
+    def new_client(self, cid=None):
+        return dbc.Client("Benchmark client {}".format(next(self.names)), cid=cid,
+                          plants=self.sample(self.pids, "plants_per_client"))
+
+    def new_plant(self, pid=None):
+        return dbc.Plant("Benchmark plant {}".format(next(self.names)), "Planta benchmark", "June",
+                         pid=pid, jobs=self.sample(self.mids, "jobs_per_plant"))
+
+    def new_job(self, mid=None):
+        return dbc.Maintenance("Benchmark job {}".format(next(self.names)), "Benchmark description",
+                               self.sample(sorting.MONTHS, "months_per_job"), mid)
+
+    def sample(self, population, size):
+        return self.rng.sample(population, min(self.sizes[size], len(population)))
+
+    def insert(self, kind, item):
+        item.insert()
+        self.inserted[kind].append(item.id)
+
+    def drop(self, kind, method):
+        with dbc.DBConnection() as c:
+            getattr(c, method)(self.inserted[kind].pop())
+
+
+def measure(operation, repeat):
+    """Run an operation and return a dictionary of its timings, statement count and peak memory."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    with tracing.traced() as log:
+        tracemalloc.start()
+        operation()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"mean_ms": sum(times) / len(times) * 1000, "min_ms": min(times) * 1000,
+            "statements": len(log), "peak_kib": peak / 1024}
+
+
+def run(sizes, repeat, seed=0):
+    """Measure every operation of a Workload on the current database and return the results by name."""
+    workload = Workload(sizes, seed)
+    return {name: measure(operation, repeat) for name, operation in workload.operations()}
+
+
+COLUMNS = [("mean_ms", "mean ms", "{:.2f}"), ("min_ms", "min ms", "{:.2f}"),
+           ("statements", "statements", "{}"), ("peak_kib", "peak KiB", "{:.1f}")]
+
+
+def report(results, baseline=None):
+    """Print a table of results, with the change from the baseline results after each figure if given."""
+    width = 18 if baseline else 12
+    print("{:<22}".format("operation") + "".join("{:>{}}".format(title, width) for _, title, _ in COLUMNS))
+    for name, result in results.items():
+        cells = []
+        for key, _, number in COLUMNS:
+            cell = number.format(result[key])
+            if baseline and name in baseline["results"]:
+                before = baseline["results"][name][key]
+                cell += " ({})".format("{:+.0%}".format(result[key] / before - 1) if before else "new")
+            cells.append("{:>{}}".format(cell, width))
+        print("{:<22}".format(name) + "".join(cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    for name, default in data.SIZES.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=int, default=default)
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of each operation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache", action="store_true", help="leave the loaded-data and export caches on")
+    parser.add_argument("--metrics", action="store_true", help="switch on the request metrics")
+    parser.add_argument("--save", metavar="FILE", help="write the results to a JSON file")
+    parser.add_argument("--compare", metavar="FILE", help="compare with results saved by --save")
+    args = parser.parse_args(argv)
+    sizes = {name: getattr(args, name) for name in data.SIZES}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline["sizes"] != sizes:
+            print("Warning: the baseline was run with sizes {}".format(baseline["sizes"]))
+
+    cache_enabled, metrics_enabled = dbc.graph_cache.enabled, dbc.metrics.enabled
+    dbc.graph_cache.enabled = dbc.export_cache.enabled = args.cache
+    dbc.metrics.enabled = args.metrics
+    try:
+        with data.dataset(seed=args.seed, **sizes):
+            results = run(sizes, args.repeat, args.seed)
+            failures = plans.check()
+    finally:
+        dbc.graph_cache.enabled = dbc.export_cache.enabled = cache_enabled
+        dbc.metrics.enabled = metrics_enabled
+
+    report(results, baseline)
+    print()
+    plans_ok = plans.report(failures)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"sizes": sizes, "repeat": args.repeat, "cache": args.cache, "metrics": args.metrics,
+                       "results": results},
+                      file, indent=2)
+    return 0 if plans_ok else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
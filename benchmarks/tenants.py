@@ -0,0 +1,139 @@
+"""A load test of one deployment serving several tenants, each from a database file of its own.
+
+For each number of tenants asked for, builds a synthetic database for
+every tenant in a temporary tenant directory (dbc.TENANT_DIRECTORY) and
+runs --workers-per-tenant worker processes per tenant for a fixed time.
+Like gunicorn workers, every process serves every tenant: each request
+goes to the subdomain of a tenant chosen at random, through the workers
+of benchmarks.load. Reports the total throughput, the throughput and
+latencies of an average tenant and any errors, then checks that no
+tenant's database holds writes meant for another:
+
+    python -m benchmarks.tenants [--tenants N ...] [--workers-per-tenant N] [--duration SECONDS]
+
+--max-open sets dbc.MAX_OPEN_DATABASES in the workers, so that setting
+it below the number of tenants measures the cost of closing and
+reopening databases.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+import dbc
+from benchmarks import data, load
+
+
+def tenant_name(n):
+    return "tenant{}".format(n)
+
+
+def work(settings, tenants, duration, write_ratio, seed, results):
+    """The body of a worker process: send requests to random tenants and put the results on a queue."""
+    try:
+        load.configure(settings)
+        workers = []
+        for tenant in tenants:
+            with dbc.use_database(dbc.tenant_database(tenant)):
+                workers.append(load.Worker("{}-{}".format(seed, tenant), write_ratio,
+                                           base_url="https://{}.garden.test".format(tenant), tag=tenant + ":"))
+        rng = random.Random(seed)
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            rng.choice(workers).step()
+        results.put({tenant: (worker.latencies, dict(worker.errors)) for tenant, worker in zip(tenants, workers)})
+    except Exception as exc:
+        results.put({"": ({"read": [], "write": []}, {"worker failed: {}".format(exc): 1})})
+
+
+def misrouted_writes(tenant):
+    """Return the number of names in a tenant's database written by requests for other tenants."""
+    with dbc.DBConnection() as c:
+        names = [row[0] for row in c.iterate("SELECT name FROM clients UNION ALL SELECT name FROM jobs")]
+    return sum(1 for name in names if ":" in name and name.split()[1].split(":")[0] != tenant)
+
+
+def load_test(settings, tenant_count, workers_per_tenant, duration, write_ratio):
+    """Run the workers against tenant_count fresh tenants and return the combined results by tenant."""
+    directory = tempfile.mkdtemp(prefix="garden-tenants-")
+    settings = dict(settings, TENANT_DIRECTORY=directory)
+    load.configure(settings)
+    tenants = [tenant_name(n) for n in range(tenant_count)]
+    try:
+        for n, tenant in enumerate(tenants):
+            data.build(dbc.tenant_database(tenant), seed=n, **load.SIZES)
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [context.Process(target=work, args=(settings, tenants, duration, write_ratio, seed, results))
+                     for seed in range(tenant_count * workers_per_tenant)]
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        misrouted = 0
+        for tenant in tenants:
+            with dbc.use_database(dbc.tenant_database(tenant)):
+                misrouted += misrouted_writes(tenant)
+    finally:
+        for tenant in tenants:
+            dbc.close_database(dbc.tenant_database(tenant))
+        shutil.rmtree(directory)
+    by_tenant = {}
+    for outcome in outcomes:
+        for tenant, (latencies, errors) in outcome.items():
+            tenant_latencies, tenant_errors = by_tenant.setdefault(tenant, ({"read": [], "write": []}, Counter()))
+            for kind, values in latencies.items():
+                tenant_latencies[kind].extend(values)
+            tenant_errors.update(errors)
+    return by_tenant, misrouted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tenants", type=int, nargs="+", default=[1, 2, 4, 8], help="numbers of tenants to test")
+    parser.add_argument("--workers-per-tenant", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10, help="seconds each number of tenants runs for")
+    parser.add_argument("--write-ratio", type=float, default=0.2, help="fraction of requests that write")
+    parser.add_argument("--config", choices=sorted(load.CONFIGS), default="production",
+                        help="SQLite settings, as in benchmarks.load")
+    parser.add_argument("--max-open", type=int, help="database files each worker keeps open")
+    args = parser.parse_args(argv)
+
+    settings = dict(load.CONFIGS[args.config])
+    if args.max_open is not None:
+        settings["MAX_OPEN_DATABASES"] = args.max_open
+    saved = {name: getattr(dbc, name) for name in list(settings) + ["TENANT_DIRECTORY"]}
+    failed = False
+    print("{:>8} {:>8} {:>10} {:>12} {:>10} {:>10} {:>8} {:>10}".format(
+        "tenants", "workers", "total r/s", "r/s a tenant", "read p50", "write p50", "errors", "misrouted"))
+    try:
+        for tenant_count in args.tenants:
+            by_tenant, misrouted = load_test(settings, tenant_count, args.workers_per_tenant, args.duration,
+                                             args.write_ratio)
+            latencies = {kind: [value for tenant_latencies, _ in by_tenant.values()
+                                for value in tenant_latencies[kind]] for kind in ("read", "write")}
+            errors = sum((tenant_errors for _, tenant_errors in by_tenant.values()), Counter())
+            requests = len(latencies["read"]) + len(latencies["write"])
+            print("{:>8} {:>8} {:>10.1f} {:>12.1f} {:>8.1f}ms {:>8.1f}ms {:>8} {:>10}".format(
+                tenant_count, tenant_count * args.workers_per_tenant, requests / args.duration,
+                requests / args.duration / tenant_count,
+                load.percentile(latencies["read"], 0.5) * 1000, load.percentile(latencies["write"], 0.5) * 1000,
+                sum(errors.values()), misrouted))
+            for message, count in errors.most_common():
+                print("    {} x {}".format(count, message))
+            failed = failed or bool(errors) or bool(misrouted)
+    finally:
+        load.configure(saved)
+    print()
+    print("{} processor(s); throughput can only grow with the number of tenants while there are spare ones."
+          .format(os.cpu_count()))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
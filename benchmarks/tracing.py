@@ -0,0 +1,67 @@
+"""Recording the SQL statements that dbc runs."""
+from contextlib import contextmanager
+
+import dbc
+
+
+class StatementLog:
+    """The SQL statements run on a database's pooled connections, in order.
+
+    Statements run by triggers are left out, since SQLite reports them
+    as comments naming the trigger rather than as statements.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, statement):
+        if not statement.startswith("--"):
+            self.statements.append(statement)
+
+    def __len__(self):
+        return len(self.statements)
+
+    def clear(self):
+        self.statements.clear()
+
+
+@contextmanager
+def traced(dbname=None):
+    """Log every statement run on the pooled connections to a database file.
+
+    Yields a StatementLog. The pool's idle connections are drained, and
+    its in-memory copy made again with new connections, on the way in
+    and out, so that every connection opened in between is traced and
+    none of them stays traced afterwards. Nothing may be holding a
+    connection from the pool when this is entered or left.
+    """
+    pool = dbc.get_pool(dbname or dbc.DATABASE)
+    log = StatementLog()
+    setup = pool.setup
+
+    def traced_setup(con):
+        setup(con)
+        con.set_trace_callback(log)
+
+    def traced_copy(con):
+        con.set_trace_callback(log)
+
+    if pool.memory is not None:
+        # Open the copy's own connection to the file first, so that its
+        # checks for changes aren't traced.
+        con = pool.memory.acquire()
+        if con is not None:
+            pool.memory.release(con)
+    pool.drain()
+    pool.setup = traced_setup
+    if pool.memory is not None:
+        pool.memory.setup = traced_copy
+        pool.memory.reset()
+    try:
+        yield log
+    finally:
+        pool.drain()
+        pool.setup = setup
+        if pool.memory is not None:
+            pool.memory.setup = None
+            pool.memory.reset()
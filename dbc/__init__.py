@@ -1,6 +1,426 @@
+import os
+import re
 import sqlite3 as sql
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import abort, current_app, g, has_app_context, request
 
 import sorting
+from dbc import migrations
+from dbc.cache import GraphCache
+from dbc.pool import ConnectionPool, WriterLock
+from dbc.stats import Metrics, RequestStats
+
+# The database file used when none is specified.
+DATABASE = "database.db"
+
+# The number of connections each process keeps open to each database file.
+POOL_SIZE = 8
+
+# The directory holding a database file for each tenant, named <tenant>.db,
+# when one deployment serves several businesses. Each request then uses
+# the file of the tenant it is for (see init_app()). When None, or for
+# requests that aren't for any tenant, DATABASE is used.
+TENANT_DIRECTORY = os.environ.get("GARDEN_DB_TENANT_DIRECTORY")
+# The most database files each process keeps connection pools open to.
+# Opening one more closes the pool of the least recently used file and
+# drops its cached objects.
+MAX_OPEN_DATABASES = int(os.environ.get("GARDEN_DB_MAX_OPEN_DATABASES", "16"))
+# A tenant name: a host name label, so that it can be a subdomain and
+# can't lead outside of TENANT_DIRECTORY.
+TENANT_NAME = re.compile(r"[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\Z")
+
+# SQLite settings for every pooled connection. For serving with several
+# worker processes, use journal mode "wal" and synchronous "normal", so
+# that reads never wait for writes; gunicorn.conf.py does this.
+# JOURNAL_MODE and SYNCHRONOUS are left at SQLite's defaults when None.
+JOURNAL_MODE = os.environ.get("GARDEN_DB_JOURNAL_MODE")
+SYNCHRONOUS = os.environ.get("GARDEN_DB_SYNCHRONOUS")
+# How many seconds a statement waits for another connection's lock before failing.
+BUSY_TIMEOUT = float(os.environ.get("GARDEN_DB_BUSY_TIMEOUT", "5"))
+# Whether write transactions queue up for a WriterLock, one at a time per database file.
+SINGLE_WRITER = os.environ.get("GARDEN_DB_SINGLE_WRITER", "0") == "1"
+# Whether to serve reads from an in-memory copy of the database, one per
+# database file in each process (see MemoryCopy). Writes still go to the
+# file, and are copied back into memory when they are committed.
+IN_MEMORY = os.environ.get("GARDEN_DB_IN_MEMORY", "0") == "1"
+
+# One line of a maintenance schedule: in a month, a client's plant needs a job doing.
+ScheduleEntry = namedtuple("ScheduleEntry", "cid month pid plant mid job description")
+
+# One line of a workload report: how many times a job needs doing for a
+# client, and how many times it needs doing for all clients together.
+WorkloadEntry = namedtuple("WorkloadEntry", "cid client mid job count total")
+
+# One match from DBConnection.search(): a plant with its latin name as the
+# detail, or a job with its description.
+SearchResult = namedtuple("SearchResult", "kind id name detail")
+
+# The full-text index of each kind of searchable item, and the column
+# holding its detail. Matches in the name count ten times more than
+# matches in the detail.
+SEARCH_INDEXES = {"plant": ("plants_search", "latin_name"), "job": ("jobs_search", "description")}
+
+# The process-wide cache of loaded Client, Plant and Maintenance lists.
+# Set graph_cache.enabled to False to switch caching off.
+graph_cache = GraphCache(maxsize=64, enabled=os.environ.get("GARDEN_DB_CACHE", "1") != "0")
+
+# The process-wide cache of each client's schedule exports, checked against
+# the client's version rather than the database's generation, so that it is
+# not emptied by writes that don't touch the client's schedule.
+export_cache = GraphCache(maxsize=256, enabled=graph_cache.enabled)
+
+# The process-wide request and SQL metrics of apps set up with init_app().
+# Off unless GARDEN_DB_METRICS=1 is set or metrics.enabled is set to True.
+metrics = Metrics(enabled=os.environ.get("GARDEN_DB_METRICS", "0") == "1")
+
+_pools = OrderedDict()
+_pools_lock = threading.Lock()
+_writer_locks = {}
+_local = threading.local()
+
+
+def init_app(app, tenant_resolver=None):
+    """Share one pooled connection between all the DBConnections of each request.
+
+    Once this has been called, the first 'with DBConnection()' block of
+    a request checks a connection out of the pool and keeps it on
+    flask.g, so that nested blocks (such as the ones in Client.insert())
+    reuse it. The connection goes back to the pool when the request ends.
+
+    With a TENANT_DIRECTORY, each request is routed to the database file
+    of its tenant, named by tenant_resolver(request), which defaults to
+    tenant_from_subdomain(). A resolver for logged-in users could look
+    the tenant up in the session instead. A request for a tenant without
+    a database file is answered with 404 Not Found.
+
+    While metrics.enabled is True, the SQL run by each request is also
+    counted and timed. The totals are sent back in a Server-Timing
+    header and added to metrics, and the slowest statements of slow
+    requests are logged. Streamed responses are recorded once they have
+    been sent, including the SQL run to make their bodies, and have no
+    Server-Timing header.
+    """
+    app.extensions["dbc"] = {"tenant_resolver": tenant_resolver or tenant_from_subdomain}
+    app.teardown_appcontext(_release_request_leases)
+    app.before_request(_start_request_stats)
+    app.before_request(_select_tenant)
+    app.after_request(_finish_request_stats)
+
+
+def tenant_from_subdomain(req):
+    """Return the tenant named by the first label of a request's host name, like acme for acme.example.com.
+
+    Host names of fewer than three labels, such as localhost or
+    example.com, and IP addresses name no tenant, so return None.
+    """
+    host = req.host.lower()
+    if host.startswith("["):
+        return None
+    labels = host.split(":")[0].split(".")
+    if len(labels) < 3 or labels[-1].isdigit():
+        return None
+    return labels[0]
+
+
+def tenant_database(tenant):
+    """Return the path of a tenant's database file in TENANT_DIRECTORY.
+
+    Raise ValueError if there is no TENANT_DIRECTORY or the name isn't
+    a valid tenant name (see TENANT_NAME).
+    """
+    if TENANT_DIRECTORY is None:
+        raise ValueError("no tenant directory has been set")
+    if not TENANT_NAME.match(tenant):
+        raise ValueError("invalid tenant name {!r}".format(tenant))
+    return os.path.join(TENANT_DIRECTORY, tenant + ".db")
+
+
+def tenants():
+    """Return a sorted list of the tenants with a database file in TENANT_DIRECTORY."""
+    if TENANT_DIRECTORY is None:
+        return []
+    return sorted(name[:-3] for name in os.listdir(TENANT_DIRECTORY)
+                  if name.endswith(".db") and TENANT_NAME.match(name[:-3]))
+
+
+def current_database():
+    """Return the database file that DBConnections use at the moment.
+
+    That is the file chosen with use_database() in this thread if there
+    is one, or else the file of the tenant the current request is for,
+    or else DATABASE.
+    """
+    dbname = getattr(_local, "database", None)
+    if dbname is None and _in_request():
+        dbname = g.get("dbc_database")
+    return dbname or DATABASE
+
+
+def current_tenant():
+    """Return the name of the tenant the current request is for, or None if it isn't for any tenant."""
+    return g.get("dbc_tenant") if _in_request() else None
+
+
+@contextmanager
+def use_database(dbname):
+    """Make the DBConnections of this thread use the given database file in the 'with' block."""
+    previous, _local.database = getattr(_local, "database", None), dbname
+    try:
+        yield dbname
+    finally:
+        _local.database = previous
+
+
+def get_pool(dbname):
+    """Return this process's connection pool for the given database file.
+
+    Pools are kept for the MAX_OPEN_DATABASES most recently used files;
+    opening one more closes the least recently used one (see
+    close_database()).
+    """
+    with _pools_lock:
+        pool = _pools.get(dbname)
+        if pool is None or pool.closed or pool.pid != os.getpid():
+            pool = _pools[dbname] = ConnectionPool(
+                dbname, POOL_SIZE, setup=_setup_connection, memory_copy=IN_MEMORY)
+        _pools.move_to_end(dbname)
+        evicted = []
+        while len(_pools) > MAX_OPEN_DATABASES:
+            evicted.append(_pools.popitem(last=False))
+            _writer_locks.pop(evicted[-1][0], None)
+    for evicted_dbname, evicted_pool in evicted:
+        _close_pool(evicted_dbname, evicted_pool)
+    return pool
+
+
+def close_database(dbname):
+    """Close this process's connections to a database file and drop everything cached from it.
+
+    Connections still in use are closed when they are released.
+    """
+    with _pools_lock:
+        pool = _pools.pop(dbname, None)
+        _writer_locks.pop(dbname, None)
+    _close_pool(dbname, pool)
+
+
+def _close_pool(dbname, pool):
+    if pool is not None:
+        pool.close()
+    graph_cache.invalidate(dbname)
+    export_cache.invalidate(dbname)
+
+
+def get_writer_lock(dbname):
+    """Return this process's WriterLock for the given database file."""
+    lock = _writer_locks.get(dbname)
+    if lock is None or lock.pid != os.getpid():
+        with _pools_lock:
+            lock = _writer_locks.get(dbname)
+            if lock is None or lock.pid != os.getpid():
+                lock = _writer_locks[dbname] = WriterLock(dbname)
+    return lock
+
+
+def migrate(dbname=None):
+    """Bring the schema of a database file up to date, creating it if need be.
+
+    Return the number of migrations applied. This is meant to be run
+    once at startup or from the command line; connections opened
+    afterwards only need to check the schema version. The database is
+    switched to JOURNAL_MODE here too, if one is set.
+    """
+    con = sql.connect(dbname or DATABASE, timeout=BUSY_TIMEOUT)
+    try:
+        _set_journal_mode(con)
+        return migrations.migrate(con)
+    finally:
+        con.close()
+
+
+def _setup_connection(con):
+    """Prepare a newly opened connection for use.
+
+    Turn on foreign key enforcement, apply the SQLite settings above
+    and check the schema version. The transactions that sqlite3 begins
+    by itself before writes outside of a transaction() take the write
+    lock straight away too (see DBConnection.transaction()). A database that hasn't been migrated
+    yet, such as a brand new file, is migrated there and then.
+    """
+    con.execute("PRAGMA foreign_keys = ON;")
+    con.isolation_level = "IMMEDIATE"
+    con.execute("PRAGMA busy_timeout = {:d}".format(int(BUSY_TIMEOUT * 1000)))
+    _set_journal_mode(con)
+    if SYNCHRONOUS:
+        con.execute("PRAGMA synchronous = {}".format(SYNCHRONOUS))
+    stats = _request_stats()
+    if stats is not None:
+        stats.connections += 1
+    if migrations.schema_version(con) != migrations.latest_version():
+        migrations.migrate(con)
+
+
+def _set_journal_mode(con):
+    """Switch the database to JOURNAL_MODE, if one is set and it isn't in that mode already.
+
+    The journal mode is stored in the database file, so this normally
+    only does anything once, when migrate() is run at startup.
+    """
+    if JOURNAL_MODE and con.execute("PRAGMA journal_mode").fetchone()[0] != JOURNAL_MODE.lower():
+        con.execute("PRAGMA journal_mode = {}".format(JOURNAL_MODE))
+
+
+def _match_query(text):
+    """Turn typed text into an FTS5 query matching every word, with the last as a prefix."""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return ""
+    return " ".join('"{}"'.format(word) for word in words) + "*"
+
+
+def _writes(method):
+    """Run a DBConnection method inside a transaction(), so that its writes always go to the database file.
+
+    Inside an enclosing transaction, the method's writes become part of
+    it as usual.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _Lease:
+    """A pooled connection checked out by the outermost of some nested DBConnections.
+
+    con is the connection to the database file, which every write goes
+    through. reader is the connection that statements outside of
+    transactions use: a connection of the lease's own to the pool's
+    MemoryCopy, brought up to date when the lease is taken, or else con
+    itself.
+    """
+
+    def __init__(self, pool, request_scoped):
+        self.pool = pool
+        self.con = pool.acquire()
+        self.reader = self.con
+        self.committed_changes = self.con.total_changes
+        self.depth = 0
+        self.transaction_depth = 0
+        self.request_scoped = request_scoped
+        self.writer_lock = None
+        if pool.memory is not None:
+            try:
+                self.refresh()
+            except BaseException:
+                self.release()
+                raise
+
+    def connection(self):
+        """Return the connection that statements should run on at the moment."""
+        return self.con if self.transaction_depth else self.reader
+
+    def refresh(self):
+        """Read from an up-to-date in-memory copy, or from the file instead if there can't be one."""
+        current = self.reader if self.reader is not self.con else None
+        reader = self.pool.memory.acquire(current)
+        if current is not None and reader is not current:
+            self.pool.memory.release(current)
+        self.reader = reader or self.con
+
+    def release(self):
+        if self.reader is not self.con:
+            self.pool.memory.release(self.reader)
+        self.pool.release(self.con)
+        self.con = self.reader = None
+
+
+def _in_request():
+    """Return whether connections should be held for the lifetime of the current Flask request."""
+    return has_app_context() and "dbc" in current_app.extensions
+
+
+def _leases():
+    """Return the dictionary of connection leases held by the current request or thread.
+
+    Inside a request of an app set up with init_app() the leases live
+    on flask.g, otherwise they are local to the thread.
+    """
+    if _in_request():
+        return g.setdefault("dbc_leases", {})
+    if not hasattr(_local, "leases"):
+        _local.leases = {}
+    return _local.leases
+
+
+def _release_request_leases(exc):
+    for lease in g.pop("dbc_leases", {}).values():
+        lease.release()
+
+
+def _request_stats():
+    """Return the RequestStats of the current request, or None if metrics are off or there is no request."""
+    if metrics.enabled and has_app_context():
+        return g.get("dbc_stats")
+    return None
+
+
+def _select_tenant():
+    """Route the request to its tenant's database file, if there is a TENANT_DIRECTORY."""
+    if TENANT_DIRECTORY is None:
+        return
+    tenant = current_app.extensions["dbc"]["tenant_resolver"](request)
+    if tenant is None:
+        return
+    try:
+        dbname = tenant_database(tenant)
+    except ValueError:
+        abort(404)
+    # Connecting would create a missing file, so check before any pool is opened for it.
+    if dbname not in _pools and not os.path.exists(dbname):
+        abort(404)
+    g.dbc_tenant = tenant
+    g.dbc_database = dbname
+
+
+def _start_request_stats():
+    if metrics.enabled:
+        g.dbc_stats = RequestStats()
+        g.dbc_started = time.perf_counter()
+
+
+def _finish_request_stats(response):
+    stats = g.get("dbc_stats")
+    if stats is None:
+        return response
+    started, tenant, path = g.dbc_started, g.get("dbc_tenant"), request.path
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    logger = current_app.logger
+
+    def finish():
+        duration = time.perf_counter() - started
+        metrics.observe(route, duration, stats, tenant)
+        if duration >= metrics.slow_request:
+            logger.warning(
+                "Slow request to %s: %.0f ms, %d statements taking %.0f ms. Slowest statements:%s",
+                path, duration * 1000, stats.statements, stats.sql_time * 1000,
+                "".join("\n    %.1f ms: %s" % (seconds * 1000, statement) for seconds, statement in stats.slowest()))
+        return duration
+
+    if response.is_streamed:
+        # The body is only made, and its SQL run, after this, so the
+        # request is recorded once the body has been sent. By then the
+        # headers are long gone, so there is no Server-Timing header.
+        response.call_on_close(finish)
+    else:
+        response.headers["Server-Timing"] = stats.server_timing(finish())
+    return response
 
 
 class DBConnection:
@@ -9,87 +429,262 @@ class DBConnection:
     def __init__(self):
         """Specify the database name and initialise connection and cursor variables.
 
+        The database is the one current_database() returns, such as the
+        file of the tenant the current request is for.
         Initialising self.con and self.cur as None has the quirk that a
         'with' statement is required to instantiate the class,
         otherwise an AttributeError is raised.
         """
-        self.dbname = "database.db"
+        self.dbname = current_database()
         self.con = None
         self.cur = None
+        self.lease = None
 
     def __enter__(self):
-        """Initialise the database.
+        """Check out a database connection.
 
-        Initialise the database connection and cursor objects, then
-        create all the tables. Calling this method by using a 'with'
-        statement will create a new blank database file.
+        Reuse the connection already held by the current request or an
+        enclosing 'with DBConnection()' block if there is one, otherwise
+        take one from the pool. Pooled connections are set up (and the
+        tables created) once, when they are first opened.
         """
-        self.con = sql.connect(self.dbname)
-        self.cur = self.con.cursor()
-        self.perform("PRAGMA foreign_keys = ON;")
-        
-        self.perform("CREATE TABLE IF NOT EXISTS clients "
-                     "(cid INTEGER PRIMARY KEY, name TEXT NOT NULL);")
-
-        self.perform("CREATE TABLE IF NOT EXISTS plants "
-                     "(pid INTEGER PRIMARY KEY, name TEXT, latin_name TEXT, "
-                     "blooming_period TEXT);")
-
-        self.perform("CREATE TABLE IF NOT EXISTS jobs "
-                     "(mid INTEGER PRIMARY KEY, name TEXT, description TEXT);")
-
-        self.perform("CREATE TABLE IF NOT EXISTS months "
-                     "(mid INTEGER REFERENCES jobs, month TEXT, PRIMARY KEY(mid, month));")
-
-        self.perform("CREATE TABLE IF NOT EXISTS client_plant_junction "
-                     "(cid INTEGER REFERENCES clients, pid INTEGER REFERENCES plants, "
-                     "PRIMARY KEY(cid, pid));")
-
-        self.perform("CREATE TABLE IF NOT EXISTS plant_job_junction "
-                     "(pid INTEGER REFERENCES plants, mid INTEGER REFERENCES jobs, "
-                     "PRIMARY KEY(pid ,mid));")
+        leases = _leases()
+        self.lease = leases.get(self.dbname)
+        if self.lease is None:
+            self.lease = leases[self.dbname] = _Lease(get_pool(self.dbname), _in_request())
+        self.lease.depth += 1
+        self._use(self.lease.connection())
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
-        """Close the database connection.
+        """Hand back the database connection.
+
+        If all goes well, commit all the uncommitted changes and return
+        True. If any exceptions occur, roll back all changes, then
+        return False to show that an exception has occurred. Inside a
+        transaction() block, committing or rolling back is left to the
+        transaction instead.
+        Once the outermost block outside of a request has finished, the
+        connection goes back to the pool. Either way, self.con and
+        self.cur are set to None.
+        """
+        if self.lease.transaction_depth == 0:
+            if tb is None:
+                self._commit()
+            else:
+                self._rollback()
+        self.lease.depth -= 1
+        if self.lease.depth == 0 and not self.lease.request_scoped:
+            del _leases()[self.dbname]
+            self.lease.release()
+        self.con = None
+        self.cur = None
+        self.lease = None
+        return tb is None
+
+    @contextmanager
+    def transaction(self):
+        """Run the statements in the 'with' block as a single unit of work.
+
+        The changes are committed together when the block ends, or all
+        rolled back if an exception escapes it. Transaction blocks
+        nested inside it, including those of nested DBConnections that
+        share this connection, become part of the outermost one.
+        The database's write lock is taken as soon as the outermost
+        transaction starts, waiting up to BUSY_TIMEOUT for other
+        writers, rather than at its first write. A transaction that
+        read first, as the search index triggers do, could otherwise
+        only fail on finding another writer, as SQLite can't wait for a
+        read lock to become a write lock.
+        With SINGLE_WRITER, every outermost transaction first waits its
+        turn for the database file's WriterLock, which it holds until
+        it has committed or rolled back.
+        With IN_MEMORY, the statements of a transaction run on the
+        database file rather than the in-memory copy, which is brought
+        up to date once the transaction has been committed.
+        """
+        lease = self.lease
+        if lease.transaction_depth == 0:
+            self._use(lease.con)
+            if SINGLE_WRITER:
+                lease.writer_lock = get_writer_lock(self.dbname)
+                lease.writer_lock.acquire()
+            try:
+                if not self.con.in_transaction:
+                    self._timed(self.con.execute, ("BEGIN IMMEDIATE",))
+            except BaseException:
+                self._end_transaction()
+                raise
+        lease.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            lease.transaction_depth -= 1
+            if lease.transaction_depth == 0:
+                try:
+                    self._rollback()
+                finally:
+                    self._end_transaction()
+            raise
+        lease.transaction_depth -= 1
+        if lease.transaction_depth == 0:
+            try:
+                self._commit()
+            finally:
+                self._end_transaction()
+
+    def _end_transaction(self):
+        """Release the writer lock, if held, and go back to reading from the lease's reader."""
+        if self.lease.writer_lock is not None:
+            self.lease.writer_lock.release()
+            self.lease.writer_lock = None
+        self._use(self.lease.connection())
+
+    def _use(self, con):
+        """Run this DBConnection's statements on con from now on.
+
+        Each statement checks which connection to use first, as a nested
+        DBConnection sharing the lease may have moved it on to a newer
+        in-memory copy after a write.
+        """
+        if con is not self.con:
+            self.con = con
+            self.cur = con.cursor()
 
-        If all goes well, commit all the uncommitted changes and set
-        self.con and self.cur to None and return True.
-        If any exceptions occur, roll back all changes, then return
-        False to show that an exception has occurred.
+    def _commit(self):
+        """Commit, and if anything was written, invalidate the cached model objects.
+
+        The in-memory copy, if there is one, is brought up to date too.
         """
-        if tb is None:
+        stats = _request_stats()
+        if stats is not None and self.con.in_transaction:
+            start = time.perf_counter()
             self.con.commit()
-            self.con.close()
-            self.con = None
-            self.cur = None
-            return True
+            stats.record_commit(time.perf_counter() - start)
         else:
-            self.con.rollback()
-            self.con.close()
-            self.con = None
-            self.cur = None
-            return False
+            self.con.commit()
+        lease = self.lease
+        if lease.con.total_changes != lease.committed_changes:
+            lease.committed_changes = lease.con.total_changes
+            graph_cache.invalidate(self.dbname)
+            if lease.pool.memory is not None:
+                lease.refresh()
+
+    def _rollback(self):
+        self.con.rollback()
+        self.lease.committed_changes = self.lease.con.total_changes
+
+    def generation(self):
+        """Return the database's change counter.
+
+        The counter is bumped by triggers whenever a row of any of the
+        data tables is inserted, updated or deleted, by any process.
+        """
+        self.execute("SELECT n FROM generation")
+        return self.fetchall()[0][0]
+
+    def version(self):
+        """Return the database's change counter and the Unix time of the last change."""
+        self.execute("SELECT n, modified FROM generation")
+        return self.fetchall()[0]
+
+    def client_version(self, cid):
+        """Return the version of a client's schedule, or None if there is no such client.
+
+        The version changes whenever anything shown in the client's
+        schedule changes, and only then.
+        """
+        self.execute("SELECT client_versions.generation FROM clients "
+                     "INNER JOIN client_versions ON client_versions.cid=clients.cid WHERE clients.cid=?", (cid,))
+        rows = self.fetchall()
+        return rows[0][0] if rows else None
+
+    def _cached(self, kind, key, load):
+        """Return the result of load(), going through graph_cache if it is enabled."""
+        if not graph_cache.enabled:
+            return load()
+        return graph_cache.get((self.dbname, kind, key), self.generation(), load)
+
+    def _iter_pages(self, kind, batch_size, page):
+        """Yield the objects of the pages returned by page(loader, after), going through graph_cache if it is enabled.
+
+        The full list is yielded from the cache if it is there, and
+        otherwise stored once the last page has been yielded, as long
+        as nothing was written meanwhile. Until then every object
+        yielded is kept for the cache, so only with the cache switched
+        off does the memory used stay within a page.
+        """
+        key, generation, loaded = (self.dbname, kind, None), None, []
+        if graph_cache.enabled:
+            generation = self.generation()
+            cached = graph_cache.lookup(key, generation)
+            if cached is not None:
+                yield from cached
+                return
+        after = 0
+        while True:
+            batch = page(GraphLoader(self), after)
+            yield from batch
+            if generation is not None:
+                loaded.extend(batch)
+            if len(batch) < batch_size:
+                break
+            after = batch[-1].id
+        if generation is not None and self.generation() == generation:
+            graph_cache.store(key, generation, loaded)
 
     def execute(self, *args):
-        """Execute an SQL statement and commit the changes.
+        """Execute an SQL statement.
 
         Takes the same arguments as sqlite3.Cursor.execute()
+        Nothing is committed here: changes are committed at the end of
+        the enclosing transaction() or 'with' block.
         """
-        self.cur.execute(*args)
-        self.con.commit()
+        self._use(self.lease.connection())
+        self._timed(self.cur.execute, args)
 
-    def perform(self, *args):
-        """Execute an SQL statement but don't commit the changes yet.
+    # Kept for older callers; execute() no longer commits either.
+    perform = execute
 
-        Takes the same arguments as sqlite3.Cursor.execute()
+    def executemany(self, *args):
+        """Execute an SQL statement once for each set of parameters.
+
+        Takes the same arguments as sqlite3.Cursor.executemany()
         """
-        self.cur.execute(*args)
+        self._use(self.lease.connection())
+        self._timed(self.cur.executemany, args)
 
     def fetchall(self):
         """Return a list of tuples representing the result from the last SELECT."""
         return self.cur.fetchall()
 
+    def iterate(self, *args):
+        """Execute a SELECT on a cursor of its own and yield the rows one at a time.
+
+        Takes the same arguments as sqlite3.Cursor.execute()
+        Unlike execute() and fetchall(), the results are never all held
+        in memory at once, and other statements can be run on this
+        DBConnection while iterating.
+        """
+        self._use(self.lease.connection())
+        cur = self.con.cursor()
+        try:
+            yield from self._timed(cur.execute, args)
+        finally:
+            cur.close()
+
+    @staticmethod
+    def _timed(run, args):
+        """Return run(*args), recording args[0] as a statement in the request's stats if metrics are on."""
+        stats = _request_stats()
+        if stats is None:
+            return run(*args)
+        start = time.perf_counter()
+        try:
+            return run(*args)
+        finally:
+            stats.record(args[0], time.perf_counter() - start)
+
     def select_clients(self, cid=None):
         """Select the client with a given client ID, or select all clients."""
         if cid is not None:
@@ -121,8 +716,9 @@ class DBConnection:
         with any plants first to avoid foreign key constraint errors,
         then delete the client's entry.
         """
-        self.delete_pc_links(cid=cid)
-        self.execute("DELETE FROM clients WHERE cid=?", (cid,))
+        with self.transaction():
+            self.delete_pc_links(cid=cid)
+            self.execute("DELETE FROM clients WHERE cid=?", (cid,))
 
     def drop_plant(self, pid):
         """Delete a plant from the database.
@@ -131,9 +727,10 @@ class DBConnection:
         with the clients that own it and remove its entries in the
         plant-maintenance link table. Finally, delete the plant itself.
         """
-        self.delete_pc_links(pid=pid)
-        self.delete_jp_links(pid=pid)
-        self.execute("DELETE FROM plants WHERE pid=?", (pid,))
+        with self.transaction():
+            self.delete_pc_links(pid=pid)
+            self.delete_jp_links(pid=pid)
+            self.execute("DELETE FROM plants WHERE pid=?", (pid,))
 
     def drop_job(self, mid):
         """Delete a maintenance job from the database.
@@ -142,69 +739,81 @@ class DBConnection:
         plant-maintenance and maintenance-month link tables, then delete
         its entry in the maintenance table.
         """
-        self.delete_jp_links(mid=mid)
-        self.delete_mj_links(mid)
-        self.execute("DELETE FROM jobs WHERE mid=?", (mid,))
+        with self.transaction():
+            self.delete_jp_links(mid=mid)
+            self.delete_mj_links(mid)
+            self.execute("DELETE FROM jobs WHERE mid=?", (mid,))
 
     def load_sql_client_data(self, cid=None):
         """Create a list of Client objects from the client table.
 
         Create a Client object from the data in each row in the client
-        table. For each Client's plants attribute, run select_pc_links()
-        to create a list of all the plants the Client has.
+        table, complete with its Plants and their Maintenance jobs.
         Running this method will result in all the data in the database
         being returned in an easy-to-use object-oriented format, which
         lets clients.html access the data in a clear and readable way
         without extra processing.
+        The whole tree is built by a GraphLoader, so the number of
+        queries run does not grow with the number of clients. The
+        result is cached in graph_cache until the database changes, so
+        it must not be modified.
         """
-        return [Client(row[1], cid=row[0],
-                       plants=self.select_pc_links(cid=row[0])) for row in self.select_clients(cid)]
+        return self._cached("clients", cid, lambda: GraphLoader(self).clients(cid))
 
     def load_sql_plant_data(self, pid=None):
         """Create a list of Plant objects from the plant table.
 
         Create a Plant object from the data in each row in the plant
-        table. For each Plant's jobs attribute, run select_mj_links()
-        to create a list of all the maintenance jobs the Plant has.
+        table, complete with the Maintenance jobs each Plant has.
+        """
+        return self._cached("plants", pid, lambda: GraphLoader(self).plants(pid))
+
+    def iter_sql_client_data(self, batch_size=100):
+        """Yield the Client objects of load_sql_client_data() one at a time.
+
+        Rather than building the whole list first, the clients are
+        loaded batch_size at a time, each batch by a GraphLoader of its
+        own, so that the first clients can be used straight away. If
+        graph_cache already holds the whole list, it is yielded from
+        there instead, and otherwise the list is cached once it has all
+        been loaded, as load_sql_client_data() would. That means keeping
+        every client yielded until the end, so the memory used only
+        stops growing with the number of clients when graph_cache is
+        switched off. Each batch is read in one go, but writes made
+        between batches may show up in the later ones.
         """
-        return [Plant(row[1], row[2], row[3], pid=row[0],
-                      jobs=self.select_jp_links(pid=row[0])) for row in self.select_plants(pid)]
+        return self._iter_pages("clients", batch_size,
+                                lambda loader, after: loader.clients_page(after, batch_size))
+
+    def iter_sql_plant_data(self, batch_size=100):
+        """Yield the Plant objects of load_sql_plant_data() one at a time, as iter_sql_client_data() does."""
+        return self._iter_pages("plants", batch_size,
+                                lambda loader, after: loader.plants_page(after, batch_size))
 
     def load_sql_job_data(self, mid=None):
         """Create a list of Maintenance objects from the job table.
 
         Create a Maintenance object from the data in each row in the
-        job table. For each Maintenance's months attribute, run
-        select_mj_links() to create a list of all the months the
-        Maintenance has.
+        job table, complete with the months each Maintenance has.
         """
-        return [Maintenance(row[1], row[2],
-                            self.select_mj_links(row[0]), row[0]) for row in self.select_jobs(mid)]
+        return self._cached("jobs", mid, lambda: GraphLoader(self).jobs(mid))
 
     def select_pc_links(self, cid=None, pid=None):
         """Process the plant-client link data.
 
         If a client ID is specified, return a list of Plant objects that
-        that client has, from the results of the select statement.
-        For each Plant's jobs attribute, run select_jp_links().
+        that client has, complete with their jobs.
         If a plant ID is specified, return a list of Client objects that
-        own that plant, from the results of the select statement.
-        For each Client's plants attribute, run select_pc_links() again
-        but with the Client's ID.
+        own that plant, complete with all of their plants.
         If no IDs are specified, return the raw data from the
         client-plant link table.
+        Objects are built by a GraphLoader, so the number of queries
+        does not depend on how many rows are linked.
         """
         if cid is not None:
-            self.execute("SELECT plants.* FROM client_plant_junction "
-                         "INNER JOIN plants ON plants.pid=client_plant_junction.pid "
-                         "WHERE cid=?", (cid,))
-            return [Plant(row[1], row[2], row[3], pid=row[0],
-                          jobs=self.select_jp_links(pid=row[0])) for row in self.fetchall()]
+            return GraphLoader(self).plants_of_client(cid)
         elif pid is not None:
-            self.execute("SELECT clients.* FROM client_plant_junction "
-                         "INNER JOIN clients ON clients.cid=client_plant_junction"
-                         "WHERE pid=?", (pid,))
-            return [Client(row[1], cid=row[0], plants=self.select_pc_links(cid=row[0])) for row in self.fetchall()]
+            return GraphLoader(self).clients_owning_plant(pid)
         else:
             self.execute("SELECT * FROM client_plant_junction")
             return self.fetchall()
@@ -213,27 +822,19 @@ class DBConnection:
         """Process the plant-maintenance link data.
 
         If a plant ID is specified, return a list of Maintenance objects
-        that that plant has, from the results of the select statement.
-        For the months attribute of each Maintenance in the list, run
-        select_mj_links().
+        that that plant has, complete with their months.
         If a maintenance ID is specified, return a list of Plant objects
-        that require the type of maintenance belonging to that ID. For
-        each Plant's jobs attribute, run select_jp_links() again but
-        with the Plant's ID.
+        that require the type of maintenance belonging to that ID,
+        complete with all of their jobs.
         If no IDs are specified, return the raw data from the plant-job
         link table.
+        Objects are built by a GraphLoader, so the number of queries
+        does not depend on how many rows are linked.
         """
         if pid is not None:
-            self.execute("SELECT jobs.* FROM plant_job_junction "
-                         "INNER JOIN jobs ON jobs.mid=plant_job_junction.mid "
-                         "WHERE pid=?", (pid,))
-            return [Maintenance(row[1], row[2], self.select_mj_links(row[0]), mid=row[0]) for row in self.fetchall()]
+            return GraphLoader(self).jobs_of_plant(pid)
         elif mid is not None:
-            self.execute("SELECT plants.* FROM plant_job_junction "
-                         "INNER JOIN plants ON plants.pid=plant_job_juncion.mid "
-                         "WHERE mid=?", (mid,))
-            return [Plant(row[1], row[2], row[3], pid=row[0],
-                          jobs=self.select_jp_links(pid=row[0])) for row in self.fetchall()]
+            return GraphLoader(self).plants_needing_job(mid)
         else:
             self.execute("SELECT * FROM plant_job_junction")
             return self.fetchall()
@@ -242,40 +843,207 @@ class DBConnection:
         """Process the maintenance-month link data.
 
         If no maintenance ID is specified, then return the raw data from
-        the month table.
-        If a maintenance ID is specified, then extract each job's month
-        from the 1-tuple that contains it and return them all in a list.
+        the month table, where months are numbers from 1 to 12.
+        If a maintenance ID is specified, then return the names of the
+        job's months in calendar order, read from its month bitmask.
         """
         if mid is None:
             self.execute("SELECT * FROM months")
             return self.fetchall()
-        else:
-            self.execute("SELECT month FROM months WHERE mid=?", (mid,))
-        return [row[0] for row in self.fetchall()]
+        self.execute("SELECT month_mask FROM jobs WHERE mid=?", (mid,))
+        rows = self.fetchall()
+        return sorting.months_from_mask(rows[0][0] if rows else 0)
 
     def select_months_of_plant(self, pid):
         """Create a list of all the months when a plant needs tending to.
 
-        Extract each month from the 1-tuple it comes in and return it
-        in a list.
+        The plant's month bitmask is the bitwise OR of the masks of all
+        of its jobs. Return the names of the months in it in calendar
+        order.
         """
-        self.execute("SELECT DISTINCT month FROM plant_job_junction "
-                     "INNER JOIN months ON plant_job_junction.mid=months.mid "
+        self.execute("SELECT jobs.month_mask FROM plant_job_junction "
+                     "INNER JOIN jobs ON jobs.mid=plant_job_junction.mid "
                      "WHERE pid=?", (pid,))
-        return [row[0] for row in self.fetchall()]
+        mask = 0
+        for row in self.fetchall():
+            mask |= row[0]
+        return sorting.months_from_mask(mask)
+
+    def select_schedule(self, cid=None, month=None):
+        """Select the maintenance schedule of a client, of a month, or of both.
+
+        The month can be given as a name or a number, but is always a
+        number in the results.
+        Return a list of ScheduleEntry tuples ordered by client, month,
+        plant and job. The rows come from the materialised schedule
+        table, so this is one indexed query whose cost depends on the
+        size of the answer rather than the size of the database.
+        """
+        self.execute(*self._schedule_query(cid, month))
+        return [ScheduleEntry(*row) for row in self.fetchall()]
 
+    def schedule_by_month(self, cid):
+        """Yield (month number, list of ScheduleEntry tuples) for each month of a client's year.
+
+        Every month from 1 to 12 is yielded, with an empty list if
+        nothing needs doing. The rows are streamed from the database,
+        so only one month is held in memory at a time.
+        """
+        month, entries = 1, []
+        for entry in map(ScheduleEntry._make, self.iterate(*self._schedule_query(cid, None))):
+            while entry.month > month:
+                yield month, entries
+                month, entries = month + 1, []
+            entries.append(entry)
+        while month <= 12:
+            yield month, entries
+            month, entries = month + 1, []
+
+    @staticmethod
+    def _schedule_query(cid, month):
+        conditions, args = [], []
+        if cid is not None:
+            conditions.append("schedule.cid=?")
+            args.append(cid)
+        if month is not None:
+            conditions.append("schedule.month=?")
+            args.append(sorting.month_number(month))
+        return ("SELECT schedule.cid, schedule.month, schedule.pid, plants.name, "
+                "schedule.mid, jobs.name, jobs.description FROM schedule "
+                "INNER JOIN plants ON plants.pid=schedule.pid "
+                "INNER JOIN jobs ON jobs.mid=schedule.mid" +
+                (" WHERE " + " AND ".join(conditions) if conditions else "") +
+                " ORDER BY schedule.cid, schedule.month, schedule.pid, schedule.mid", args)
+
+    def workload(self, month=None):
+        """Return a list of WorkloadEntry tuples counting the jobs to do in a month, or in the whole year.
+
+        For each client and job, count is the number of times the job
+        needs doing: once for each of the client's plants needing it in
+        each month. total is the count for all clients together. The
+        counts are read from the workload table, which triggers on the
+        schedule table keep up to date, so nothing is counted here.
+        Entries are ordered by client ID, then by job name. The result
+        is cached in graph_cache until the database changes.
+        """
+        month = sorting.month_number(month) if month is not None else None
+        return self._cached("workload", month, lambda: self._workload(month))
+
+    def _workload(self, month):
+        # The whole year is counted as month 0. Each name is read once
+        # rather than once per row, and the rows are put in order here,
+        # which is cheaper than having SQLite join and sort them.
+        args = (month or 0,)
+        self.execute("SELECT cid, name FROM clients WHERE cid IN (SELECT cid FROM workload WHERE month=?)", args)
+        clients = dict(self.fetchall())
+        self.execute("SELECT mid, name FROM jobs WHERE mid IN (SELECT mid FROM workload WHERE month=?)", args)
+        jobs = dict(self.fetchall())
+        self.execute("SELECT cid, mid, n FROM workload WHERE month=?", args)
+        rows = self.fetchall()
+        totals = dict.fromkeys(jobs, 0)
+        for _, mid, count in rows:
+            totals[mid] += count
+        # SQLite sorts NULL names before all others.
+        order = {mid: n for n, mid in enumerate(sorted(jobs, key=lambda mid: (jobs[mid] is not None, jobs[mid] or "")))}
+        rows.sort(key=lambda row: (row[0], order[row[1]]))
+        make = WorkloadEntry._make
+        return [make((cid, clients[cid], mid, jobs[mid], count, totals[mid])) for cid, mid, count in rows]
+
+    def search(self, text, kinds=("plant", "job"), limit=10):
+        """Return up to limit SearchResults for plants and jobs matching some text, best first.
+
+        Every word of the text must appear in the name or the detail of
+        an item, and the last word only has to be the start of a word,
+        so that results can be shown while the text is being typed.
+        kinds picks which of "plant" and "job" to search.
+        """
+        query = _match_query(text)
+        if not query or not kinds:
+            return []
+        selects, args = [], []
+        for kind in kinds:
+            index, detail = SEARCH_INDEXES[kind]
+            selects.append("SELECT * FROM (SELECT '{kind}', rowid, name, {detail}, bm25({index}, 10.0, 1.0) AS score "
+                           "FROM {index} WHERE {index} MATCH ? ORDER BY score LIMIT ?)"
+                           .format(kind=kind, detail=detail, index=index))
+            args.extend((query, limit))
+        self.execute(" UNION ALL ".join(selects) + " ORDER BY 5 LIMIT ?", args + [limit])
+        return [SearchResult(*row[:4]) for row in self.fetchall()]
+
+    @_writes
     def link_plant_to_client(self, cid, pid):
         """Take a client ID and plant ID and link the plant to the client."""
         self.execute("INSERT INTO client_plant_junction (cid,pid) VALUES (?,?)", (cid, pid))
 
+    @_writes
     def link_job_to_plant(self, pid, mid):
         """Take a plant ID and maintenance ID and link the job to the plant."""
         self.execute("INSERT INTO plant_job_junction (pid,mid) VALUES (?,?)", (pid, mid))
 
+    @_writes
     def link_month_to_job(self, mid, month):
-        """Take a maintenance ID and month name and link the month to the job."""
-        self.execute("INSERT INTO months (mid,month) VALUES (?,?)", (mid, month))
+        """Take a maintenance ID and month name or number and link the month to the job."""
+        self.execute("INSERT INTO months (mid,month) VALUES (?,?)", (mid, sorting.month_number(month)))
+
+    @_writes
+    def link_plants_to_client(self, cid, pids):
+        """Take a client ID and a list of plant IDs and link all the plants to the client at once."""
+        self.executemany("INSERT INTO client_plant_junction (cid,pid) VALUES (?,?)", [(cid, pid) for pid in pids])
+
+    @_writes
+    def link_jobs_to_plant(self, pid, mids):
+        """Take a plant ID and a list of maintenance IDs and link all the jobs to the plant at once."""
+        self.executemany("INSERT INTO plant_job_junction (pid,mid) VALUES (?,?)", [(pid, mid) for mid in mids])
+
+    @_writes
+    def link_months_to_job(self, mid, months):
+        """Take a maintenance ID and a list of month names or numbers and link all the months to the job at once."""
+        self.executemany("INSERT INTO months (mid,month) VALUES (?,?)",
+                         [(mid, sorting.month_number(month)) for month in months])
+
+    def relink_plants_to_client(self, cid, pids):
+        """Make the plants linked to a client exactly the ones in the list of plant IDs.
+
+        Only the links that have been added or removed are written.
+        Return the number of link rows inserted or deleted.
+        """
+        return self._relink("client_plant_junction", "cid", cid, "pid", {int(pid) for pid in pids})
 
+    def relink_jobs_to_plant(self, pid, mids):
+        """Make the jobs linked to a plant exactly the ones in the list of maintenance IDs.
+
+        Only the links that have been added or removed are written.
+        Return the number of link rows inserted or deleted.
+        """
+        return self._relink("plant_job_junction", "pid", pid, "mid", {int(mid) for mid in mids})
+
+    def relink_months_to_job(self, mid, months):
+        """Make the months linked to a job exactly the ones in the list of month names or numbers.
+
+        Only the links that have been added or removed are written.
+        Return the number of link rows inserted or deleted.
+        """
+        return self._relink("months", "mid", mid, "month", {sorting.month_number(month) for month in months})
+
+    @_writes
+    def _relink(self, table, key, key_value, column, wanted):
+        """Bring the rows of a link table for one key in line with the wanted set of values.
+
+        The stored rows are read inside the write transaction, once the
+        write lock has been taken, so that no other writer can change
+        them before the differences are written.
+        """
+        self.execute("SELECT {} FROM {} WHERE {}=?".format(column, table, key), (key_value,))
+        stored = {row[0] for row in self.fetchall()}
+        removed = [(key_value, value) for value in stored - wanted]
+        added = [(key_value, value) for value in wanted - stored]
+        if removed:
+            self.executemany("DELETE FROM {} WHERE {}=? AND {}=?".format(table, key, column), removed)
+        if added:
+            self.executemany("INSERT INTO {} ({},{}) VALUES (?,?)".format(table, key, column), added)
+        return len(removed) + len(added)
+
+    @_writes
     def delete_pc_links(self, cid=None, pid=None):
         """Delete link data between plants and clients.
 
@@ -293,6 +1061,7 @@ class DBConnection:
         elif pid is not None:
             self.execute("DELETE FROM client_plant_junction WHERE pid=?", (pid,))
 
+    @_writes
     def delete_jp_links(self, pid=None, mid=None):
         """Delete link data between maintenance jobs and plants.
 
@@ -310,20 +1079,211 @@ class DBConnection:
         elif mid is not None:
             self.execute("DELETE FROM plant_job_junction WHERE mid=?", (mid,))
 
+    @_writes
     def delete_mj_links(self, mid):
         """Delete link data between maintenance jobs and months for the specified job ID."""
         if mid is not None:
             self.execute("DELETE FROM months WHERE mid=?", (mid,))
 
 
+class GraphLoader:
+    """Eager loader for the client -> plant -> maintenance object graph.
+
+    Builds the same trees as following the link tables one row at a
+    time, but with a single set-based query per level of the tree:
+    one for the clients, one for client_plant_junction joined with
+    plants and one for plant_job_junction joined with jobs, whose
+    months come from their month bitmasks. The rows of each level are
+    then attached to their parents in Python.
+
+    Each level is scoped by an optional SQL sub-select producing the
+    IDs to load, so that loading a single client, or one page of
+    clients, only touches the rows belonging to those clients. The
+    depth of the tree can be limited too, in which case the deepest
+    level loaded holds lists of IDs instead of objects.
+
+    The loader keeps an identity map, so that every plant and job row
+    it reads becomes exactly one object however many clients or plants
+    it is linked to: three hundred clients owning the same rose share
+    one Plant and its Maintenance jobs rather than holding a copy each.
+    Shared objects are the same objects, so code that changes a loaded
+    plant changes it for every client that owns it. The map lasts as
+    long as the loader, so use a new GraphLoader for each load.
+    """
+
+    def __init__(self, connection, identity_map=True):
+        """Take the open DBConnection to run the queries on.
+
+        identity_map can be turned off to give every link its own copy
+        of the objects it leads to, for comparison.
+        """
+        self.connection = connection
+        self.identity_map = identity_map
+        self._objects = {}
+
+    def clients(self, cid=None, depth=2):
+        """Return a list of Client objects, or just the one with the given ID.
+
+        With a depth of 2 the clients have Plants with Maintenance jobs,
+        with 1 they have Plants with job IDs and with 0 just plant IDs.
+        """
+        if cid is None:
+            return self._clients(None, (), depth)
+        return self._clients("SELECT cid FROM clients WHERE cid=?", (cid,), depth)
+
+    def plants(self, pid=None, depth=1):
+        """Return a list of Plant objects, or just the one with the given ID.
+
+        With a depth of 1 the plants have Maintenance jobs, with 0 just
+        job IDs.
+        """
+        if pid is None:
+            return self._plants(None, (), depth)
+        return self._plants("SELECT pid FROM plants WHERE pid=?", (pid,), depth)
+
+    def jobs(self, mid=None):
+        """Return a list of Maintenance objects, or just the one with the given ID."""
+        if mid is None:
+            return self._jobs(None, ())
+        return self._jobs("SELECT mid FROM jobs WHERE mid=?", (mid,))
+
+    def clients_page(self, after=0, limit=50, depth=2):
+        """Return up to limit Client objects with IDs greater than after, in ID order."""
+        return self._clients(*self._page("clients", "cid", after, limit), depth=depth)
+
+    def plants_page(self, after=0, limit=50, depth=1):
+        """Return up to limit Plant objects with IDs greater than after, in ID order."""
+        return self._plants(*self._page("plants", "pid", after, limit), depth=depth)
+
+    def jobs_page(self, after=0, limit=50):
+        """Return up to limit Maintenance objects with IDs greater than after, in ID order."""
+        return self._jobs(*self._page("jobs", "mid", after, limit))
+
+    def clients_owning_plant(self, pid):
+        """Return a list of the Client objects that own the plant with the given ID."""
+        return self._clients("SELECT cid FROM client_plant_junction WHERE pid=?", (pid,))
+
+    def plants_of_client(self, cid):
+        """Return a list of the Plant objects that the client with the given ID owns."""
+        return self._plants("SELECT pid FROM client_plant_junction WHERE cid=?", (cid,))
+
+    def plants_needing_job(self, mid):
+        """Return a list of the Plant objects that need the maintenance job with the given ID."""
+        return self._plants("SELECT pid FROM plant_job_junction WHERE mid=?", (mid,))
+
+    def jobs_of_plant(self, pid):
+        """Return a list of the Maintenance objects that the plant with the given ID needs."""
+        return self._jobs("SELECT mid FROM plant_job_junction WHERE pid=?", (pid,))
+
+    @staticmethod
+    def _where(column, ids_sql):
+        """Return a WHERE clause restricting column to the IDs selected by ids_sql, if any."""
+        return "" if ids_sql is None else " WHERE {} IN ({})".format(column, ids_sql)
+
+    @staticmethod
+    def _page(table, key, after, limit):
+        """Return the sub-select and arguments for a keyset-paginated page of IDs."""
+        return ("SELECT {key} FROM {table} WHERE {key}>? ORDER BY {key} LIMIT ?".format(key=key, table=table),
+                (after, limit))
+
+    def _select(self, sql, args):
+        self.connection.execute(sql, args)
+        return self.connection.fetchall()
+
+    def _clients(self, cids_sql, args, depth=2):
+        """Load the clients selected by cids_sql along with all of their plants."""
+        if depth == 0:
+            plants = self._linked_ids("client_plant_junction", "cid", "pid", cids_sql, args)
+        else:
+            pids_sql = "SELECT pid FROM client_plant_junction" + self._where("cid", cids_sql)
+            if depth == 1:
+                jobs = self._linked_ids("plant_job_junction", "pid", "mid", pids_sql, args)
+            else:
+                jobs = self._jobs_of_plants(pids_sql, args)
+
+            plants = {}
+            for cid, pid, name, latin_name, blooming_period in self._select(
+                    "SELECT cp.cid, plants.pid, plants.name, plants.latin_name, plants.blooming_period "
+                    "FROM client_plant_junction AS cp "
+                    "INNER JOIN plants ON plants.pid=cp.pid" + self._where("cp.cid", cids_sql) +
+                    " ORDER BY cp.cid, plants.pid", args):
+                plants.setdefault(cid, []).append(self._shared(
+                    (Plant, pid, depth - 1),
+                    lambda: Plant(name, latin_name, blooming_period, pid=pid, jobs=jobs.get(pid, []))))
+
+        return [Client(name, cid=cid, plants=plants.get(cid, []))
+                for cid, name in self._select("SELECT cid, name FROM clients" +
+                                              self._where("cid", cids_sql) + " ORDER BY cid", args)]
+
+    def _plants(self, pids_sql, args, depth=1):
+        """Load the plants selected by pids_sql along with all of their jobs."""
+        if depth == 0:
+            jobs = self._linked_ids("plant_job_junction", "pid", "mid", pids_sql, args)
+        else:
+            jobs = self._jobs_of_plants(pids_sql, args)
+        return [self._shared((Plant, pid, depth),
+                             lambda: Plant(name, latin_name, blooming_period, pid=pid, jobs=jobs.get(pid, [])))
+                for pid, name, latin_name, blooming_period in self._select(
+                    "SELECT pid, name, latin_name, blooming_period FROM plants" +
+                    self._where("pid", pids_sql) + " ORDER BY pid", args)]
+
+    def _jobs(self, mids_sql, args):
+        """Load the maintenance jobs selected by mids_sql along with their months."""
+        return [self._shared((Maintenance, mid), lambda: Maintenance(name, description, month_mask, mid))
+                for mid, name, description, month_mask in self._select(
+                    "SELECT mid, name, description, month_mask FROM jobs" +
+                    self._where("mid", mids_sql) + " ORDER BY mid", args)]
+
+    def _jobs_of_plants(self, pids_sql, args):
+        """Return a dictionary mapping plant IDs to lists of the Maintenance jobs they have."""
+        jobs = {}
+        for pid, mid, name, description, month_mask in self._select(
+                "SELECT pj.pid, jobs.mid, jobs.name, jobs.description, jobs.month_mask "
+                "FROM plant_job_junction AS pj "
+                "INNER JOIN jobs ON jobs.mid=pj.mid" + self._where("pj.pid", pids_sql) +
+                " ORDER BY pj.pid, jobs.mid", args):
+            jobs.setdefault(pid, []).append(self._shared(
+                (Maintenance, mid), lambda: Maintenance(name, description, month_mask, mid)))
+        return jobs
+
+    def _shared(self, key, make):
+        """Return the object already loaded under key, or make() it and remember it.
+
+        The key of a plant includes how deep its jobs were loaded, so a
+        plant with job IDs is never handed out where one with
+        Maintenance jobs is expected.
+        """
+        if not self.identity_map:
+            return make()
+        try:
+            return self._objects[key]
+        except KeyError:
+            obj = self._objects[key] = make()
+            return obj
+
+    def _linked_ids(self, table, key, column, keys_sql, args):
+        """Return a dictionary mapping the keys selected by keys_sql to lists of the IDs linked to them."""
+        linked = {}
+        for key_value, value in self._select("SELECT {key}, {column} FROM {table}".format(
+                key=key, column=column, table=table) + self._where(key, keys_sql) +
+                " ORDER BY {}, {}".format(key, column), args):
+            linked.setdefault(key_value, []).append(value)
+        return linked
+
+
 class DBItem:
     """Base superclass for database entries.
 
     Every database entry has a name and an ID, and must be able to
     insert itself into the database and update the entry corresponding
     to its ID.
+    Entries are held in large numbers by the loaded object graph, so
+    they use __slots__ rather than a __dict__ each; subclasses must
+    declare their own attributes in __slots__ too.
     """
 
+    __slots__ = ("name", "id")
+
     def __init__(self, name, id_=None):
         self.name = name or ""
         self.id = id_ or -1
@@ -336,6 +1296,8 @@ class DBItem:
 class Client(DBItem):
     """Client class. Inherits DBItem and has a list of plants owned and their IDs."""
 
+    __slots__ = ("plants",)
+
     def __init__(self, name, cid=None, plants=None):
         """Initialises the Client's attributes.
 
@@ -344,135 +1306,171 @@ class Client(DBItem):
         is calculated automatically by SQLite. The ID is only specified
         when reading from the database.
         The list of plants can be specified either as a list of IDs or
-        as a list of Plant objects. If the type of the first item in the
-        list is a Plant, then extract their IDs and store those in a
-        separate variable.
+        as a list of Plant objects.
         """
         super().__init__(name, cid)
         self.plants = plants or []
-        self.pids = self.plants
-        if self.plants and type(self.plants[0]) == Plant:
-            self.pids = [plant.id for plant in self.plants]
+
+    @property
+    def pids(self):
+        """Return the IDs of the plants owned, whether they are Plant objects or IDs already."""
+        return [plant.id if isinstance(plant, Plant) else plant for plant in self.plants]
 
     def insert(self):
         """Insert this Client's data into the database.
 
-        Inserts the client's name, then links all the plants they own.
+        Inserts the client's name, then links all the plants they own,
+        all in one transaction.
         """
-        with DBConnection() as c:
+        with DBConnection() as c, c.transaction():
             c.execute("INSERT INTO clients (name) VALUES (?)", (self.name,))
             c.execute("SELECT last_insert_rowid()")
             self.id = c.fetchall()[0][0]
-            for pid in self.pids:
-                c.link_plant_to_client(cid=self.id, pid=pid)
+            c.link_plants_to_client(self.id, self.pids)
 
     def update(self):
         """Update the database record corresponding to this Client's ID.
 
-        Update the name, and also re-link the plants in case any plant
-        links have changed.
+        Update the name, and also re-link any plants that have been
+        added or removed. Return the number of rows written.
         """
-        with DBConnection() as c:
+        with DBConnection() as c, c.transaction():
             c.execute("UPDATE clients "
                       "SET name=? WHERE cid=?",
                       (self.name, self.id))
-            c.delete_pc_links(cid=self.id)
-            for pid in self.pids:
-                c.link_plant_to_client(cid=self.id, pid=pid)
+            return c.cur.rowcount + c.relink_plants_to_client(self.id, self.pids)
 
 
 class Plant(DBItem):
     """Plant class. Inherits DBItem.
 
     Has a latin name, blooming period, list of maintenance jobs and a
-    list of the months when this plant needs tending to.
+    list of the months when this plant needs tending to, which is
+    worked out from the jobs rather than read from the database.
     """
 
+    __slots__ = ("latin_name", "blooming_period", "jobs")
+
     def __init__(self, name, latin_name, blooming_period, pid=None, jobs=None):
         """Initialise the Plant's attributes.
 
-        If the job list is a list of Maintenance objects then extract
-        each Maintenance's ID and store them separately.
+        The job list can be a list of IDs or of Maintenance objects.
         """
         super().__init__(name, pid)
         self.latin_name = latin_name
         self.blooming_period = blooming_period
         self.jobs = jobs or []
-        self.mids = self.jobs
-        if self.jobs and type(self.jobs[0]) == Maintenance:
-            self.mids = [job.id for job in self.jobs]
-        with DBConnection() as c:
-            self.months = c.select_months_of_plant(self.id)
+
+    @property
+    def mids(self):
+        """Return the IDs of this plant's jobs, whether they are Maintenance objects or IDs already."""
+        return [job.id if isinstance(job, Maintenance) else job for job in self.jobs]
+
+    @property
+    def month_mask(self):
+        """Return the bitmask of the months when this plant needs tending to.
+
+        This is the bitwise OR of the masks of all of the plant's
+        Maintenance jobs. If the jobs are only known by their IDs, as
+        with a Plant made from form data, then there are no months to
+        report; use DBConnection.select_months_of_plant() to look them
+        up instead.
+        """
+        mask = 0
+        for job in self.jobs:
+            if isinstance(job, Maintenance):
+                mask |= job.month_mask
+        return mask
+
+    @property
+    def months(self):
+        """Return the names of the months when this plant needs tending to, in calendar order."""
+        return sorting.months_from_mask(self.month_mask)
+
+    def in_month(self, month):
+        """Return whether this plant needs tending to in a month, given by name or number."""
+        return bool(self.month_mask & (1 << (sorting.month_number(month) - 1)))
 
     def insert(self):
         """Insert this Plant's data into the database.
 
         Inserts the plant's name, latin name and blooming period, then
-        links all necessary Maintenance jobs.
+        links all necessary Maintenance jobs, all in one transaction.
         """
-        with DBConnection() as c:
+        with DBConnection() as c, c.transaction():
             c.execute("INSERT INTO plants (name,latin_name,blooming_period) VALUES (?,?,?)",
                       (self.name, self.latin_name, self.blooming_period))
             c.execute("SELECT last_insert_rowid()")
             self.id = c.fetchall()[0][0]
-            for mid in self.mids:
-                c.link_job_to_plant(pid=self.id, mid=mid)
+            c.link_jobs_to_plant(self.id, self.mids)
 
     def update(self):
         """Update the database record corresponding to this Plant's ID.
 
         Update the normal name, latin name and blooming period, and
-        re-link any maintenance jobs in case this data has changed.
+        re-link any maintenance jobs that have been added or removed.
+        Return the number of rows written.
         """
-        with DBConnection() as c:
+        with DBConnection() as c, c.transaction():
             c.execute("UPDATE plants "
                       "SET name=?, latin_name=?, blooming_period=? "
                       "WHERE pid=?",
                       (self.name, self.latin_name, self.blooming_period, self.id))
-            c.delete_jp_links(pid=self.id)
-            for mid in self.mids:
-                c.link_job_to_plant(pid=self.id, mid=mid)
+            return c.cur.rowcount + c.relink_jobs_to_plant(self.id, self.mids)
 
 
 class Maintenance(DBItem):
     """Maintenance job class. Inherits DBItem.
 
-    Has a description and a list of English full names of the months to
-    which it applies.
+    Has a description and the months to which it applies, which are
+    stored as a 12-bit mask with bit n - 1 set for month n.
     """
 
+    __slots__ = ("description", "month_mask")
+
     def __init__(self, name, description, months, mid=None):
         """Initialise the Maintenance's attributes.
 
-        Sort the list of months using the utility from sorting as the key.
+        The months can be given as a list of month names or numbers, or
+        as a month bitmask.
         """
         super().__init__(name, mid)
         self.description = description or ""
-        self.months = sorted(months, key=sorting.dt_from_month) if months is not None else []
+        if isinstance(months, int):
+            self.month_mask = months
+        else:
+            self.month_mask = sorting.month_mask(months or [])
+
+    @property
+    def months(self):
+        """Return the English full names of this job's months, in calendar order."""
+        return sorting.months_from_mask(self.month_mask)
+
+    def in_month(self, month):
+        """Return whether this job applies to a month, given by name or number."""
+        return bool(self.month_mask & (1 << (sorting.month_number(month) - 1)))
 
     def insert(self):
         """Insert this Maintenance's data into the database.
 
-        Insert the name and description, then link all necessary months.
+        Insert the name and description, then link all necessary months,
+        all in one transaction.
         """
-        with DBConnection() as c:
+        with DBConnection() as c, c.transaction():
             c.execute("INSERT INTO jobs (name,description) VALUES (?,?)",
                       (self.name, self.description))
             c.execute("SELECT last_insert_rowid()")
             self.id = c.fetchall()[0][0]
-            for month in self.months:
-                c.link_month_to_job(self.id, month)
+            c.link_months_to_job(self.id, self.months)
 
     def update(self):
         """Update the database record corresponding to this job's ID.
 
-        Update the name and description, and relink the months in case
-        any of these have changed.
+        Update the name and description, and relink any months that
+        have been added or removed. Return the number of rows written.
         """
-        with DBConnection() as c:
+        with DBConnection() as c, c.transaction():
             c.execute("UPDATE jobs "
                       "SET name=?, description=? WHERE mid=?",
                       (self.name, self.description, self.id))
-            c.delete_mj_links(self.id)
-            for month in self.months:
-                c.link_month_to_job(self.id, month)
+            return c.cur.rowcount + c.relink_months_to_job(self.id, self.months)
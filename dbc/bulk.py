@@ -0,0 +1,218 @@
+"""Streaming bulk import and export.
+
+Data is exchanged as a stream of records, each a dictionary with a
+"kind" of "job", "plant" or "client":
+
+    {"kind": "job", "name": ..., "description": ..., "months": [month names]}
+    {"kind": "plant", "name": ..., "latin_name": ..., "blooming_period": ..., "jobs": [job names]}
+    {"kind": "client", "name": ..., "plants": [plant names]}
+
+Jobs and plants are referred to by name, so they must come before the
+records that use them. Records can be read from and written to JSON
+Lines or CSV files; in CSV, the list columns are separated by
+semicolons.
+"""
+import csv
+import json
+
+from werkzeug.exceptions import BadRequest
+
+import sorting
+
+# The number of rows written per executemany() call.
+BATCH_SIZE = 5000
+
+CSV_COLUMNS = ["kind", "name", "description", "months", "latin_name", "blooming_period", "jobs", "plants"]
+LIST_COLUMNS = ["months", "jobs", "plants"]
+
+
+class Importer:
+    """Writes a stream of records into the database in large batches.
+
+    Names of existing jobs, plants and clients are mapped to their IDs
+    up front, and new rows are given IDs by the importer, so that rows
+    can be queued up and written with executemany() instead of one
+    statement (and one ID lookup) per row. A record whose name already
+    exists adds its links to the existing row instead of creating a
+    new one, which makes importing the same file twice harmless.
+    This must be used inside a transaction that holds the write lock,
+    such as DBConnection.transaction().
+    """
+
+    # Queued statements are flushed in this order, so that rows are
+    # always written before the link rows that refer to them.
+    STATEMENTS = [
+        "INSERT INTO jobs (mid,name,description) VALUES (?,?,?)",
+        "INSERT INTO plants (pid,name,latin_name,blooming_period) VALUES (?,?,?,?)",
+        "INSERT INTO clients (cid,name) VALUES (?,?)",
+        "INSERT OR IGNORE INTO months (mid,month) VALUES (?,?)",
+        "INSERT OR IGNORE INTO plant_job_junction (pid,mid) VALUES (?,?)",
+        "INSERT OR IGNORE INTO client_plant_junction (cid,pid) VALUES (?,?)",
+    ]
+
+    def __init__(self, connection):
+        """Take an open DBConnection and read the existing names and IDs."""
+        self.connection = connection
+        self.ids = {}
+        self.next_id = {}
+        for kind, table, key in (("job", "jobs", "mid"), ("plant", "plants", "pid"), ("client", "clients", "cid")):
+            self.ids[kind] = {name: id_ for id_, name in connection.iterate(
+                "SELECT {}, name FROM {} ORDER BY {}".format(key, table, key))}
+            connection.execute("SELECT coalesce(max({}), 0) + 1 FROM {}".format(key, table))
+            self.next_id[kind] = connection.fetchall()[0][0]
+        self.queued = {statement: [] for statement in self.STATEMENTS}
+        self.counts = {"job": 0, "plant": 0, "client": 0, "links": 0}
+
+    def add(self, record):
+        """Queue up the rows for one record."""
+        kind = record.get("kind")
+        if kind == "job":
+            mid = self._row_id(kind, record, self.STATEMENTS[0],
+                               lambda id_: (id_, record["name"], record.get("description") or ""))
+            for month in record.get("months") or []:
+                self._queue(self.STATEMENTS[3], (mid, self._month(month)))
+        elif kind == "plant":
+            pid = self._row_id(kind, record, self.STATEMENTS[1],
+                               lambda id_: (id_, record["name"], record.get("latin_name"),
+                                            record.get("blooming_period")))
+            for job in record.get("jobs") or []:
+                self._queue(self.STATEMENTS[4], (pid, self._lookup("job", job)))
+        elif kind == "client":
+            cid = self._row_id(kind, record, self.STATEMENTS[2], lambda id_: (id_, record["name"]))
+            for plant in record.get("plants") or []:
+                self._queue(self.STATEMENTS[5], (cid, self._lookup("plant", plant)))
+        else:
+            raise ValueError("unknown record kind {!r}".format(kind))
+
+    def flush(self):
+        """Write all the queued rows."""
+        for statement, rows in self.queued.items():
+            if rows:
+                self.connection.executemany(statement, rows)
+                rows.clear()
+
+    def _row_id(self, kind, record, statement, row):
+        """Return the ID for a record's name, queueing a new row if the name is new."""
+        name = record.get("name")
+        if not name:
+            raise ValueError("{} record has no name".format(kind))
+        if name not in self.ids[kind]:
+            self.ids[kind][name] = self.next_id[kind]
+            self.next_id[kind] += 1
+            self._queue(statement, row(self.ids[kind][name]))
+            self.counts[kind] += 1
+        return self.ids[kind][name]
+
+    @staticmethod
+    def _month(month):
+        try:
+            return sorting.month_number(month)
+        except BadRequest:
+            raise ValueError("unknown month {!r}".format(month))
+
+    def _lookup(self, kind, name):
+        try:
+            return self.ids[kind][name]
+        except KeyError:
+            raise ValueError("unknown {} {!r}".format(kind, name))
+
+    def _queue(self, statement, row):
+        rows = self.queued[statement]
+        rows.append(row)
+        if statement not in self.STATEMENTS[:3]:
+            self.counts["links"] += 1
+        if len(rows) >= BATCH_SIZE:
+            self.flush()
+
+
+def import_records(connection, records):
+    """Import an iterable of records in a single transaction.
+
+    Return a dictionary counting the new jobs, plants and clients and
+    the link rows processed (links that already existed are left as
+    they are). If any record is invalid, nothing is
+    imported and a ValueError is raised saying which record it was.
+    """
+    with connection.transaction():
+        importer = Importer(connection)
+        for number, record in enumerate(records, 1):
+            try:
+                importer.add(record)
+            except (ValueError, KeyError) as exc:
+                raise ValueError("record {}: {}".format(number, exc)) from exc
+        importer.flush()
+    return importer.counts
+
+
+def export_records(connection):
+    """Yield every job, plant and client in the database as a record.
+
+    Rows are streamed from the database one at a time, so memory use
+    does not grow with the size of the database. Jobs come first, then
+    plants, then clients, so the output can be imported again.
+    """
+    for mid, name, description, month_mask in connection.iterate(
+            "SELECT mid, name, description, month_mask FROM jobs ORDER BY mid"):
+        yield {"kind": "job", "name": name, "description": description,
+               "months": sorting.months_from_mask(month_mask)}
+    yield from _grouped(connection, "plant", "jobs",
+                        "SELECT plants.pid, plants.name, plants.latin_name, plants.blooming_period, jobs.name "
+                        "FROM plants LEFT JOIN plant_job_junction AS pj ON pj.pid=plants.pid "
+                        "LEFT JOIN jobs ON jobs.mid=pj.mid ORDER BY plants.pid, jobs.mid",
+                        ("name", "latin_name", "blooming_period"))
+    yield from _grouped(connection, "client", "plants",
+                        "SELECT clients.cid, clients.name, plants.name "
+                        "FROM clients LEFT JOIN client_plant_junction AS cp ON cp.cid=clients.cid "
+                        "LEFT JOIN plants ON plants.pid=cp.pid ORDER BY clients.cid, plants.pid",
+                        ("name",))
+
+
+def _grouped(connection, kind, list_field, sql, fields):
+    """Yield one record per ID from a query whose rows are (ID, *fields, linked name), ordered by ID."""
+    record, current = None, None
+    for row in connection.iterate(sql):
+        if row[0] != current:
+            if record is not None:
+                yield record
+            current = row[0]
+            record = dict(zip(fields, row[1:-1]), kind=kind)
+            record[list_field] = []
+        if row[-1] is not None:
+            record[list_field].append(row[-1])
+    if record is not None:
+        yield record
+
+
+def read_jsonl(file):
+    """Yield the records in a JSON Lines file, skipping blank lines."""
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def write_jsonl(records, file):
+    """Write records to a file as JSON Lines."""
+    for record in records:
+        file.write(json.dumps(record) + "\n")
+
+
+def read_csv(file):
+    """Yield the records in a CSV file with a header row, splitting the list columns."""
+    for row in csv.DictReader(file):
+        record = {key: value for key, value in row.items() if value}
+        for column in LIST_COLUMNS:
+            if column in record:
+                record[column] = record[column].split(";")
+        yield record
+
+
+def write_csv(records, file):
+    """Write records to a CSV file with a header row, joining the list columns."""
+    writer = csv.DictWriter(file, CSV_COLUMNS)
+    writer.writeheader()
+    for record in records:
+        row = dict(record)
+        for column in LIST_COLUMNS:
+            if column in row:
+                row[column] = ";".join(row[column])
+        writer.writerow(row)
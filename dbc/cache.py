@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+
+class GraphCache:
+    """A bounded, generation-checked cache of loaded model objects.
+
+    Each entry is stored along with the database generation (see
+    DBConnection.generation()) it was loaded at, and is only returned
+    while the generation is unchanged. The generation is bumped by
+    triggers on every write, so changes made by other processes are
+    noticed too. Writes made through dbc also invalidate the cache
+    directly.
+
+    Keys are tuples whose first item is the database file name, and
+    the entries of each database file are kept apart: once a file has
+    maxsize entries, its least recently used one is dropped, so that
+    a busy database never pushes out the entries of the others.
+    """
+
+    def __init__(self, maxsize=64, enabled=True):
+        """Set the maximum number of entries for each database file and whether caching is switched on."""
+        self.maxsize = maxsize
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, generation, load):
+        """Return the cached value for key, calling load() to fill the cache if need be.
+
+        A value cached at a different generation counts as a miss.
+        """
+        value = self.lookup(key, generation)
+        if value is None:
+            value = load()
+            self.store(key, generation, value)
+        return value
+
+    def lookup(self, key, generation):
+        """Return the value cached for key at the given generation, or None if there isn't one."""
+        with self._lock:
+            entries = self._databases.get(key[0])
+            entry = entries.get(key) if entries is not None else None
+            if entry is not None and entry[0] == generation:
+                entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def store(self, key, generation, value):
+        """Cache a value, which must not be None, for key at the given generation."""
+        with self._lock:
+            entries = self._databases.setdefault(key[0], OrderedDict())
+            entries[key] = (generation, value)
+            entries.move_to_end(key)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def invalidate(self, dbname=None):
+        """Drop every entry, or just the entries belonging to one database file."""
+        with self._lock:
+            if dbname is None:
+                self._databases.clear()
+            else:
+                self._databases.pop(dbname, None)
+
+    def stats(self):
+        """Return a dictionary of the hit and miss counts, the current size and the number of database files."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": sum(len(entries) for entries in self._databases.values()),
+                    "maxsize": self.maxsize, "databases": len(self._databases)}
@@ -0,0 +1,78 @@
+"""iCalendar (RFC 5545) export of a client's maintenance schedule.
+
+Each job in a month of the schedule becomes one all-day event lasting
+the whole month and repeating every year, listing the client's plants
+that need the job in its description. Events are marked as free time,
+so that they don't block anything out in the gardeners' calendars.
+"""
+from datetime import date, datetime, timezone
+from itertools import groupby
+
+import sorting
+
+PRODUCT_ID = "-//garden-db//Maintenance schedule//EN"
+
+
+def calendar(client_name, schedule, stamp=None, year=None):
+    """Yield the text of an iCalendar file a few lines at a time.
+
+    schedule is an iterable of (month number, list of ScheduleEntry
+    tuples), as yielded by DBConnection.schedule_by_month(), and is only
+    gone through once. Jobs and plants without names are listed with
+    empty ones. stamp is the datetime the calendar was made at, and the
+    events start in the given year; both default to now.
+    """
+    stamp = stamp or datetime.now(timezone.utc)
+    year = year or stamp.year
+    yield _lines(["BEGIN:VCALENDAR",
+                  "VERSION:2.0",
+                  "PRODID:" + PRODUCT_ID,
+                  "CALSCALE:GREGORIAN",
+                  "METHOD:PUBLISH",
+                  "X-WR-CALNAME:" + escape("{} - maintenance".format(client_name))])
+    for month, entries in schedule:
+        start = date(year, month, 1)
+        end = date(year + month // 12, month % 12 + 1, 1)
+        for (mid, job), job_entries in groupby(sorted(entries, key=lambda entry: (entry.job or "", entry.mid)),
+                                               key=lambda entry: (entry.mid, entry.job or "")):
+            job_entries = list(job_entries)
+            description = "{}\n\n{}".format(job_entries[0].description or "",
+                                            "\n".join(entry.plant or "" for entry in job_entries))
+            yield _lines(["BEGIN:VEVENT",
+                          "UID:garden-db-{}-{}-{}".format(job_entries[0].cid, month, mid),
+                          "DTSTAMP:" + stamp.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ"),
+                          "DTSTART;VALUE=DATE:" + start.strftime("%Y%m%d"),
+                          "DTEND;VALUE=DATE:" + end.strftime("%Y%m%d"),
+                          "RRULE:FREQ=YEARLY",
+                          "SUMMARY:" + escape("{} ({})".format(job, sorting.MONTHS[month - 1])),
+                          "DESCRIPTION:" + escape(description),
+                          "TRANSP:TRANSPARENT",
+                          "END:VEVENT"])
+    yield _lines(["END:VCALENDAR"])
+
+
+def escape(text):
+    """Escape a TEXT property value."""
+    return (text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def fold(line):
+    """Fold a content line so that no line is longer than 75 octets, without splitting characters."""
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line
+    parts, start, limit = [], 0, 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Back up to the start of a UTF-8 character.
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode("utf-8"))
+        # Continuation lines start with a space, which counts towards their length.
+        start, limit = end, 74
+    return "\r\n ".join(parts)
+
+
+def _lines(lines):
+    return "".join(fold(line) + "\r\n" for line in lines)
@@ -0,0 +1,356 @@
+"""Versioned schema migrations.
+
+The schema version of a database is kept in its PRAGMA user_version,
+which is the number of migrations that have been applied to it. Each
+migration is a function taking an sqlite3.Connection, registered in
+order with the @migration decorator. Migrations must never be edited
+or reordered once released; to change the schema, add a new one to the
+end of the list.
+"""
+import sqlite3 as sql
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """Register a function as the next migration in the list."""
+    MIGRATIONS.append(func)
+    return func
+
+
+def latest_version():
+    """Return the schema version that a fully migrated database has."""
+    return len(MIGRATIONS)
+
+
+def schema_version(con):
+    """Return the schema version of the database behind a connection."""
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(con):
+    """Apply all outstanding migrations to the database behind a connection.
+
+    The migrations run in a single transaction, which holds the write
+    lock from the start so that two processes starting at once can't
+    both apply the same migration. Return the number of migrations
+    applied.
+    """
+    if con.in_transaction:
+        con.commit()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        version = schema_version(con)
+        if version > latest_version():
+            raise sql.DatabaseError("database schema version {} is newer than this code's version {}"
+                                    .format(version, latest_version()))
+        for step in MIGRATIONS[version:]:
+            step(con)
+        con.execute("PRAGMA user_version = {}".format(latest_version()))
+    except BaseException:
+        con.rollback()
+        raise
+    con.commit()
+    return latest_version() - version
+
+
+@migration
+def create_tables(con):
+    """Create the original tables.
+
+    Databases from before schema versioning already have these, so
+    they are only created if they don't exist.
+    """
+    con.execute("CREATE TABLE IF NOT EXISTS clients "
+                "(cid INTEGER PRIMARY KEY, name TEXT NOT NULL);")
+
+    con.execute("CREATE TABLE IF NOT EXISTS plants "
+                "(pid INTEGER PRIMARY KEY, name TEXT, latin_name TEXT, "
+                "blooming_period TEXT);")
+
+    con.execute("CREATE TABLE IF NOT EXISTS jobs "
+                "(mid INTEGER PRIMARY KEY, name TEXT, description TEXT);")
+
+    con.execute("CREATE TABLE IF NOT EXISTS months "
+                "(mid INTEGER REFERENCES jobs, month TEXT, PRIMARY KEY(mid, month));")
+
+    con.execute("CREATE TABLE IF NOT EXISTS client_plant_junction "
+                "(cid INTEGER REFERENCES clients, pid INTEGER REFERENCES plants, "
+                "PRIMARY KEY(cid, pid));")
+
+    con.execute("CREATE TABLE IF NOT EXISTS plant_job_junction "
+                "(pid INTEGER REFERENCES plants, mid INTEGER REFERENCES jobs, "
+                "PRIMARY KEY(pid ,mid));")
+
+
+@migration
+def index_reverse_links(con):
+    """Index the second column of each junction table.
+
+    The composite primary keys only help lookups by client (or by
+    plant, for jobs); these indexes make finding the clients that own
+    a plant, or the plants that need a job, an index search too.
+    """
+    con.execute("CREATE INDEX client_plant_junction_pid ON client_plant_junction (pid)")
+    con.execute("CREATE INDEX plant_job_junction_mid ON plant_job_junction (mid)")
+
+
+@migration
+def create_schedule(con):
+    """Create the materialised maintenance schedule.
+
+    Each row of the schedule says that in a month, a client's plant
+    needs a maintenance job doing. It is the join of
+    client_plant_junction, plant_job_junction and months, kept up to
+    date by triggers on those tables so that a client's or a month's
+    schedule can be read with a single index search.
+    """
+    con.execute("CREATE TABLE schedule "
+                "(cid INTEGER NOT NULL, month TEXT NOT NULL, pid INTEGER NOT NULL, mid INTEGER NOT NULL, "
+                "PRIMARY KEY(cid, month, pid, mid)) WITHOUT ROWID")
+    con.execute("CREATE INDEX schedule_month ON schedule (month, cid)")
+    con.execute("CREATE INDEX schedule_job ON schedule (mid, pid)")
+
+    con.execute("INSERT INTO schedule (cid, month, pid, mid) "
+                "SELECT cp.cid, months.month, cp.pid, months.mid FROM client_plant_junction AS cp "
+                "INNER JOIN plant_job_junction AS pj ON pj.pid=cp.pid "
+                "INNER JOIN months ON months.mid=pj.mid")
+
+    con.execute("CREATE TRIGGER schedule_add_plant AFTER INSERT ON client_plant_junction BEGIN "
+                "INSERT OR IGNORE INTO schedule (cid, month, pid, mid) "
+                "SELECT NEW.cid, months.month, NEW.pid, months.mid FROM plant_job_junction AS pj "
+                "INNER JOIN months ON months.mid=pj.mid WHERE pj.pid=NEW.pid; END")
+    con.execute("CREATE TRIGGER schedule_remove_plant AFTER DELETE ON client_plant_junction BEGIN "
+                "DELETE FROM schedule WHERE cid=OLD.cid AND pid=OLD.pid; END")
+
+    con.execute("CREATE TRIGGER schedule_add_job AFTER INSERT ON plant_job_junction BEGIN "
+                "INSERT OR IGNORE INTO schedule (cid, month, pid, mid) "
+                "SELECT cp.cid, months.month, NEW.pid, NEW.mid FROM client_plant_junction AS cp "
+                "INNER JOIN months ON months.mid=NEW.mid WHERE cp.pid=NEW.pid; END")
+    con.execute("CREATE TRIGGER schedule_remove_job AFTER DELETE ON plant_job_junction BEGIN "
+                "DELETE FROM schedule WHERE mid=OLD.mid AND pid=OLD.pid; END")
+
+    con.execute("CREATE TRIGGER schedule_add_month AFTER INSERT ON months BEGIN "
+                "INSERT OR IGNORE INTO schedule (cid, month, pid, mid) "
+                "SELECT cp.cid, NEW.month, pj.pid, NEW.mid FROM plant_job_junction AS pj "
+                "INNER JOIN client_plant_junction AS cp ON cp.pid=pj.pid WHERE pj.mid=NEW.mid; END")
+    con.execute("CREATE TRIGGER schedule_remove_month AFTER DELETE ON months BEGIN "
+                "DELETE FROM schedule WHERE mid=OLD.mid AND month=OLD.month; END")
+
+
+@migration
+def number_months(con):
+    """Store months as numbers from 1 to 12 and give each job a month bitmask.
+
+    The months and schedule tables are rebuilt with an integer month
+    column, converting the English month names already stored. jobs
+    gains a month_mask column, with bit n - 1 set if the job applies
+    to month n, which is kept in step with the months table by
+    triggers. The schedule triggers have to be dropped while months is
+    rebuilt, and are recreated afterwards.
+    """
+    for trigger in ("schedule_add_plant", "schedule_remove_plant", "schedule_add_job",
+                    "schedule_remove_job", "schedule_add_month", "schedule_remove_month"):
+        con.execute("DROP TRIGGER {}".format(trigger))
+    con.execute("DROP TABLE schedule")
+
+    month_case = "CASE month {} END".format(" ".join(
+        "WHEN '{}' THEN {}".format(name, number) for number, name in enumerate(
+            ["January", "February", "March", "April", "May", "June", "July",
+             "August", "September", "October", "November", "December"], 1)))
+    con.execute("CREATE TABLE months_new "
+                "(mid INTEGER REFERENCES jobs, month INTEGER NOT NULL CHECK(month BETWEEN 1 AND 12), "
+                "PRIMARY KEY(mid, month))")
+    con.execute("INSERT INTO months_new (mid, month) "
+                "SELECT mid, {} FROM months WHERE {} IS NOT NULL".format(month_case, month_case))
+    con.execute("DROP TABLE months")
+    con.execute("ALTER TABLE months_new RENAME TO months")
+
+    con.execute("ALTER TABLE jobs ADD COLUMN month_mask INTEGER NOT NULL DEFAULT 0")
+    # Each (mid, month) pair is unique, so summing the bits is the same as ORing them.
+    con.execute("UPDATE jobs SET month_mask="
+                "(SELECT coalesce(sum(1 << (month - 1)), 0) FROM months WHERE months.mid=jobs.mid)")
+    con.execute("CREATE TRIGGER month_mask_add AFTER INSERT ON months BEGIN "
+                "UPDATE jobs SET month_mask=month_mask | (1 << (NEW.month - 1)) WHERE mid=NEW.mid; END")
+    con.execute("CREATE TRIGGER month_mask_remove AFTER DELETE ON months BEGIN "
+                "UPDATE jobs SET month_mask=month_mask & ~(1 << (OLD.month - 1)) WHERE mid=OLD.mid; END")
+
+    con.execute("CREATE TABLE schedule "
+                "(cid INTEGER NOT NULL, month INTEGER NOT NULL, pid INTEGER NOT NULL, mid INTEGER NOT NULL, "
+                "PRIMARY KEY(cid, month, pid, mid)) WITHOUT ROWID")
+    con.execute("CREATE INDEX schedule_month ON schedule (month, cid)")
+    con.execute("CREATE INDEX schedule_job ON schedule (mid, pid)")
+
+    con.execute("INSERT INTO schedule (cid, month, pid, mid) "
+                "SELECT cp.cid, months.month, cp.pid, months.mid FROM client_plant_junction AS cp "
+                "INNER JOIN plant_job_junction AS pj ON pj.pid=cp.pid "
+                "INNER JOIN months ON months.mid=pj.mid")
+
+    con.execute("CREATE TRIGGER schedule_add_plant AFTER INSERT ON client_plant_junction BEGIN "
+                "INSERT OR IGNORE INTO schedule (cid, month, pid, mid) "
+                "SELECT NEW.cid, months.month, NEW.pid, months.mid FROM plant_job_junction AS pj "
+                "INNER JOIN months ON months.mid=pj.mid WHERE pj.pid=NEW.pid; END")
+    con.execute("CREATE TRIGGER schedule_remove_plant AFTER DELETE ON client_plant_junction BEGIN "
+                "DELETE FROM schedule WHERE cid=OLD.cid AND pid=OLD.pid; END")
+
+    con.execute("CREATE TRIGGER schedule_add_job AFTER INSERT ON plant_job_junction BEGIN "
+                "INSERT OR IGNORE INTO schedule (cid, month, pid, mid) "
+                "SELECT cp.cid, months.month, NEW.pid, NEW.mid FROM client_plant_junction AS cp "
+                "INNER JOIN months ON months.mid=NEW.mid WHERE cp.pid=NEW.pid; END")
+    con.execute("CREATE TRIGGER schedule_remove_job AFTER DELETE ON plant_job_junction BEGIN "
+                "DELETE FROM schedule WHERE mid=OLD.mid AND pid=OLD.pid; END")
+
+    con.execute("CREATE TRIGGER schedule_add_month AFTER INSERT ON months BEGIN "
+                "INSERT OR IGNORE INTO schedule (cid, month, pid, mid) "
+                "SELECT cp.cid, NEW.month, pj.pid, NEW.mid FROM plant_job_junction AS pj "
+                "INNER JOIN client_plant_junction AS cp ON cp.pid=pj.pid WHERE pj.mid=NEW.mid; END")
+    con.execute("CREATE TRIGGER schedule_remove_month AFTER DELETE ON months BEGIN "
+                "DELETE FROM schedule WHERE mid=OLD.mid AND month=OLD.month; END")
+
+
+@migration
+def count_generations(con):
+    """Add a change counter that is bumped by every write to the data tables.
+
+    The generation table has a single row whose n column goes up by
+    one for each row inserted, updated or deleted, whichever process
+    made the change, so that caches can tell when they are stale.
+    """
+    con.execute("CREATE TABLE generation (id INTEGER PRIMARY KEY CHECK(id = 0), n INTEGER NOT NULL)")
+    con.execute("INSERT INTO generation (id, n) VALUES (0, 0)")
+    for table in ("clients", "plants", "jobs", "months", "client_plant_junction", "plant_job_junction"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            con.execute("CREATE TRIGGER generation_{table}_{event} AFTER {event} ON {table} BEGIN "
+                        "UPDATE generation SET n=n + 1; END".format(table=table, event=event.lower()))
+
+
+@migration
+def time_generations(con):
+    """Record when the generation counter was last bumped.
+
+    The generation triggers are recreated so that each bump also sets
+    the modified column to the current Unix time, in the same UPDATE.
+    """
+    con.execute("ALTER TABLE generation ADD COLUMN modified INTEGER NOT NULL DEFAULT 0")
+    con.execute("UPDATE generation SET modified=CAST(strftime('%s', 'now') AS INTEGER)")
+    for table in ("clients", "plants", "jobs", "months", "client_plant_junction", "plant_job_junction"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            con.execute("DROP TRIGGER generation_{table}_{event}".format(table=table, event=event.lower()))
+            con.execute("CREATE TRIGGER generation_{table}_{event} AFTER {event} ON {table} BEGIN "
+                        "UPDATE generation SET n=n + 1, modified=CAST(strftime('%s', 'now') AS INTEGER); END"
+                        .format(table=table, event=event.lower()))
+
+
+@migration
+def index_search(con):
+    """Add full-text search indexes over plants and jobs.
+
+    plants_search indexes the names and latin names of plants, and
+    jobs_search the names and descriptions of jobs. Both are FTS5
+    external content tables, so the text itself stays in the plants
+    and jobs tables, with the rowid being the plant or job ID, and
+    they are kept in step with those tables by triggers. Prefixes of up
+    to three characters are indexed too, for autocompletion.
+    """
+    for table, key, columns in (("plants", "pid", ("name", "latin_name")), ("jobs", "mid", ("name", "description"))):
+        index = table + "_search"
+        new = ", ".join("NEW." + column for column in columns)
+        old = ", ".join("OLD." + column for column in columns)
+        con.execute("CREATE VIRTUAL TABLE {index} USING fts5({columns}, content='{table}', content_rowid='{key}', "
+                    "tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')"
+                    .format(index=index, columns=", ".join(columns), table=table, key=key))
+        con.execute("INSERT INTO {index} ({index}) VALUES ('rebuild')".format(index=index))
+        con.execute("CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN "
+                    "INSERT INTO {index} (rowid, {columns}) VALUES (NEW.{key}, {new}); END"
+                    .format(index=index, table=table, key=key, columns=", ".join(columns), new=new))
+        con.execute("CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN "
+                    "INSERT INTO {index} ({index}, rowid, {columns}) VALUES ('delete', OLD.{key}, {old}); END"
+                    .format(index=index, table=table, key=key, columns=", ".join(columns), old=old))
+        con.execute("CREATE TRIGGER {index}_update AFTER UPDATE OF {columns} ON {table} BEGIN "
+                    "INSERT INTO {index} ({index}, rowid, {columns}) VALUES ('delete', OLD.{key}, {old}); "
+                    "INSERT INTO {index} (rowid, {columns}) VALUES (NEW.{key}, {new}); END"
+                    .format(index=index, table=table, key=key, columns=", ".join(columns), old=old, new=new))
+
+
+@migration
+def version_clients(con):
+    """Keep a version number for each client's maintenance schedule.
+
+    client_versions holds a number for each client that goes up
+    whenever something shown in the client's schedule may have changed:
+    the client's name or plants, the jobs of those plants, the months of
+    those jobs, or the names of the plants and jobs. Each bump takes the
+    version past both its old value and the generation counter, so
+    versions only ever go up, and rows are kept when clients are deleted
+    so that a new client given a deleted client's ID carries on from
+    its version. Caches of a client's schedule stay valid for as long as
+    its version is unchanged, however much the rest of the database
+    changes.
+    """
+    bump = ("INSERT INTO client_versions (cid, generation) SELECT {cids}, generation.n FROM {tables} WHERE {where} "
+            "ON CONFLICT(cid) DO UPDATE SET generation=max(generation + 1, excluded.generation);")
+    triggers = [
+        ("add_client", "INSERT ON clients", "NEW.cid", "generation", "true"),
+        ("rename_client", "UPDATE OF name ON clients", "NEW.cid", "generation", "true"),
+        ("add_plant", "INSERT ON client_plant_junction", "NEW.cid", "generation", "true"),
+        ("remove_plant", "DELETE ON client_plant_junction", "OLD.cid", "generation", "true"),
+        ("rename_plant", "UPDATE OF name ON plants", "cp.cid", "client_plant_junction AS cp, generation",
+         "cp.pid=NEW.pid"),
+        ("add_job", "INSERT ON plant_job_junction", "cp.cid", "client_plant_junction AS cp, generation",
+         "cp.pid=NEW.pid"),
+        ("remove_job", "DELETE ON plant_job_junction", "cp.cid", "client_plant_junction AS cp, generation",
+         "cp.pid=OLD.pid"),
+        ("change_job", "UPDATE OF name, description ON jobs", "DISTINCT cp.cid",
+         "plant_job_junction AS pj INNER JOIN client_plant_junction AS cp ON cp.pid=pj.pid, generation",
+         "pj.mid=NEW.mid"),
+        ("add_month", "INSERT ON months", "DISTINCT cp.cid",
+         "plant_job_junction AS pj INNER JOIN client_plant_junction AS cp ON cp.pid=pj.pid, generation",
+         "pj.mid=NEW.mid"),
+        ("remove_month", "DELETE ON months", "DISTINCT cp.cid",
+         "plant_job_junction AS pj INNER JOIN client_plant_junction AS cp ON cp.pid=pj.pid, generation",
+         "pj.mid=OLD.mid"),
+    ]
+    con.execute("CREATE TABLE client_versions (cid INTEGER PRIMARY KEY, generation INTEGER NOT NULL)")
+    con.execute(bump.format(cids="clients.cid", tables="clients, generation", where="true"))
+    for name, event, cids, tables, where in triggers:
+        con.execute("CREATE TRIGGER client_versions_{} AFTER {} BEGIN ".format(name, event) +
+                    bump.format(cids=cids, tables=tables, where=where) + " END")
+
+
+@migration
+def index_schedule_jobs_by_month(con):
+    """Order the schedule_month index by job within each client.
+
+    A month's schedule can then be counted by client and job without
+    sorting. The job ID was already stored in the index as part of the
+    primary key, so the index stays the same size.
+    """
+    con.execute("DROP INDEX schedule_month")
+    con.execute("CREATE INDEX schedule_month ON schedule (month, cid, mid)")
+
+
+@migration
+def count_workload(con):
+    """Keep count of the jobs to do for each client in each month, and in the whole year.
+
+    Each row of workload says how many times a job needs doing for a
+    client in a month: once for each of the client's plants needing it.
+    The rows with month 0 count the whole year. The counts are kept up
+    to date by triggers on the schedule table, so that a workload report
+    reads one row for each client and job instead of counting the
+    schedule.
+    """
+    con.execute("CREATE TABLE workload "
+                "(month INTEGER NOT NULL, cid INTEGER NOT NULL, mid INTEGER NOT NULL, n INTEGER NOT NULL, "
+                "PRIMARY KEY(month, cid, mid)) WITHOUT ROWID")
+    con.execute("INSERT INTO workload (month, cid, mid, n) "
+                "SELECT month, cid, mid, COUNT(*) FROM schedule GROUP BY month, cid, mid")
+    con.execute("INSERT INTO workload (month, cid, mid, n) "
+                "SELECT 0, cid, mid, SUM(n) FROM workload GROUP BY cid, mid")
+
+    con.execute("CREATE TRIGGER workload_add AFTER INSERT ON schedule BEGIN "
+                "INSERT INTO workload (month, cid, mid, n) VALUES (NEW.month, NEW.cid, NEW.mid, 1), "
+                "(0, NEW.cid, NEW.mid, 1) ON CONFLICT(month, cid, mid) DO UPDATE SET n=n + 1; END")
+    con.execute("CREATE TRIGGER workload_remove AFTER DELETE ON schedule BEGIN "
+                "UPDATE workload SET n=n - 1 WHERE month IN (OLD.month, 0) AND cid=OLD.cid AND mid=OLD.mid; "
+                "DELETE FROM workload WHERE month IN (OLD.month, 0) AND cid=OLD.cid AND mid=OLD.mid AND n=0; END")
@@ -0,0 +1,258 @@
+import itertools
+import os
+import queue
+import sqlite3 as sql
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ConnectionPool:
+    """A fixed-size pool of SQLite connections to one database file.
+
+    Connections are opened lazily, up to the size of the pool, and the
+    setup function is run once on each of them when it is opened
+    rather than every time it is handed out. Once every connection is
+    in use, acquire() waits for one to be released. Once the pool has
+    been closed, connections released to it are closed too.
+    """
+
+    def __init__(self, dbname, size, setup=None, timeout=30, memory_copy=False):
+        """Specify the database file, pool size and connection setup function.
+
+        setup is called with each new sqlite3.Connection. timeout is the
+        number of seconds acquire() waits for a free connection before
+        giving up. If memory_copy is True, the pool also keeps a
+        MemoryCopy of the database, as memory.
+        """
+        self.dbname = dbname
+        self.size = size
+        self.setup = setup
+        self.timeout = timeout
+        self.memory = MemoryCopy(self._open) if memory_copy else None
+        self.pid = os.getpid()
+        self.closed = False
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Check a connection out of the pool, opening a new one if there is room."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            room = self._opened < self.size
+            if room:
+                self._opened += 1
+        if room:
+            try:
+                return self._open()
+            except BaseException:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sql.OperationalError("timed out waiting for a connection to {}".format(self.dbname))
+
+    def release(self, con):
+        """Return a connection to the pool, rolling back anything left uncommitted."""
+        if con.in_transaction:
+            con.rollback()
+        with self._lock:
+            if not self.closed:
+                self._idle.put(con)
+                return
+            self._opened -= 1
+        con.close()
+
+    def close(self):
+        """Close every idle connection in the pool, and every other one as it is released."""
+        with self._lock:
+            self.closed = True
+        self.drain()
+        if self.memory is not None:
+            self.memory.close()
+
+    def drain(self):
+        """Close every idle connection in the pool, leaving it open for new ones."""
+        while True:
+            try:
+                con = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            con.close()
+            with self._lock:
+                self._opened -= 1
+
+    def _open(self):
+        con = sql.connect(self.dbname, check_same_thread=False)
+        if self.setup is not None:
+            self.setup(con)
+        return con
+
+
+class MemoryCopy:
+    """A read-only copy of a database file in memory, shared by every thread of a process.
+
+    The copy is made with SQLite's backup API into a named in-memory
+    database in shared-cache mode, and acquire() hands out connections
+    of their own to it, so that threads don't queue up on a single
+    connection. Connections given back with release() are kept for the
+    next acquire() while the copy is up to date.
+
+    The copy is made again by acquire() whenever the file has been
+    changed since, by any connection in this process or another. Each
+    change is copied once, by whichever thread first asks for the copy
+    after it; threads asking while that copy is being made are told to
+    read the file instead of waiting for it. A new copy is made in a new
+    in-memory database, so threads still reading the old one carry on
+    undisturbed, and the old one is freed once its last connection has
+    been dropped. Writes to the copy fail, rather than being lost at the
+    next change.
+    """
+
+    _names = itertools.count()
+
+    def __init__(self, connect):
+        """Take a function returning a new connection to the database file.
+
+        The attribute setup can be set to a function to call with each
+        new connection to the copy, such as one tracing its statements.
+        """
+        self.connect = connect
+        self.setup = None
+        self._watch = None
+        self._keeper = None
+        self._uri = None
+        self._version = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self._copying = threading.Lock()
+
+    def acquire(self, current=None):
+        """Return a connection to an up-to-date copy of the database.
+
+        current is a connection to the copy already held by the caller,
+        which is returned as it is if the copy is still up to date.
+        Return None if there isn't an up-to-date copy at the moment:
+        while another thread is making it, or if it couldn't be made,
+        such as when the file is locked by a writer for longer than the
+        busy timeout.
+        """
+        with self._lock:
+            if self._watch is None:
+                self._watch = self.connect()
+            # data_version changes whenever any other connection commits,
+            # which includes all the connections of the pool.
+            version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+            if self._keeper is not None and version == self._version:
+                if current is not None and current.uri == self._uri:
+                    return current
+                if self._idle:
+                    return self._idle.pop()
+                return self._open(self._uri)
+        if not self._copying.acquire(blocking=False):
+            return None
+        try:
+            # The version is read before copying, so a change committed
+            # during the backup is copied again next time.
+            uri = "file:garden-copy-{}?mode=memory&cache=shared".format(next(self._names))
+            keeper = sql.connect(uri, uri=True, check_same_thread=False)
+            source = self.connect()
+            try:
+                source.backup(keeper)
+            except sql.OperationalError:
+                keeper.close()
+                return None
+            finally:
+                source.close()
+            with self._lock:
+                self._discard()
+                self._keeper, self._uri, self._version = keeper, uri, version
+                return self._open(uri)
+        finally:
+            self._copying.release()
+
+    def release(self, con):
+        """Give back a connection from acquire(), to be used again while the copy is up to date.
+
+        Connections to an old copy are just dropped rather than closed,
+        in case something still reads from them.
+        """
+        with self._lock:
+            if self._keeper is not None and con.uri == self._uri:
+                self._idle.append(con)
+
+    def reset(self):
+        """Make the copy again, with new connections, the next time it is asked for."""
+        with self._lock:
+            self._discard()
+
+    def close(self):
+        """Close the connection watching the file and let go of the copy."""
+        with self._lock:
+            if self._watch is not None:
+                self._watch.close()
+            self._watch = None
+            self._discard()
+
+    def _open(self, uri):
+        con = sql.connect(uri, uri=True, check_same_thread=False, factory=_CopyConnection)
+        con.uri = uri
+        con.execute("PRAGMA query_only = ON")
+        if self.setup is not None:
+            self.setup(con)
+        return con
+
+    def _discard(self):
+        """Let go of the current copy and close its idle connections."""
+        for con in self._idle:
+            con.close()
+        if self._keeper is not None:
+            self._keeper.close()
+        self._idle, self._keeper, self._uri, self._version = [], None, None, None
+
+
+class _CopyConnection(sql.Connection):
+    """A connection to one of the in-memory databases of a MemoryCopy, whose uri says which."""
+
+
+class WriterLock:
+    """A lock that lets one writer at a time, in any thread or process, at a database file.
+
+    Threads of one process queue on a threading.Lock, and processes on
+    an flock() of a file next to the database, so waiting writers sleep
+    until it is their turn instead of polling SQLite's write lock until
+    the busy timeout runs out. Where flock() isn't available, only the
+    threads of each process are kept in line.
+    """
+
+    def __init__(self, dbname):
+        self.path = dbname + "-writer.lock"
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._file = None
+
+    def acquire(self):
+        self._lock.acquire()
+        if fcntl is None:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def release(self):
+        if fcntl is not None and self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._lock.release()
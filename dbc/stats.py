@@ -0,0 +1,151 @@
+import heapq
+import threading
+
+# The upper bounds, in seconds, of the request latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RequestStats:
+    """The SQL statistics of one request.
+
+    Counts the statements executed through DBConnection, the commits
+    and the pooled connections opened, adds up the time spent in
+    SQLite, and keeps the slowest few statements.
+    """
+
+    def __init__(self, keep=5):
+        """Set how many of the slowest statements to keep."""
+        self.statements = 0
+        self.commits = 0
+        self.connections = 0
+        self.sql_time = 0.0
+        self.keep = keep
+        self._slowest = []
+
+    def record(self, statement, duration):
+        """Record one statement and the number of seconds it took."""
+        self.statements += 1
+        self.sql_time += duration
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, (duration, statement))
+        else:
+            heapq.heappushpop(self._slowest, (duration, statement))
+
+    def record_commit(self, duration):
+        """Record one commit and the number of seconds it took."""
+        self.commits += 1
+        self.sql_time += duration
+
+    def slowest(self):
+        """Return a list of (seconds, statement) for the slowest statements, slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+    def server_timing(self, total):
+        """Return a Server-Timing header value for a request that took total seconds."""
+        return ('sql;desc="{} statements, {} commits, {} connections opened";dur={:.2f}, '
+                'total;dur={:.2f}'.format(self.statements, self.commits, self.connections,
+                                          self.sql_time * 1000, total * 1000))
+
+
+class _RouteMetrics:
+    def __init__(self, buckets):
+        self.buckets = [0] * len(buckets)
+        self.count = 0
+        self.duration = 0.0
+        self.statements = 0
+        self.commits = 0
+        self.connections = 0
+        self.sql_time = 0.0
+
+
+class Metrics:
+    """Process-wide request and SQL metrics, by tenant and route.
+
+    Each request's RequestStats are added to the totals of its route
+    along with how long the request took, which goes into a latency
+    histogram. The requests of each tenant are totalled separately and
+    labelled with the tenant's name. render() reports them in
+    Prometheus' text format, either all of them or just one tenant's.
+    Nothing is recorded unless enabled is True.
+    """
+
+    def __init__(self, enabled=False, buckets=BUCKETS, slow_request=0.5):
+        """Set whether metrics are switched on, the histogram buckets and the slow request time.
+
+        Requests taking at least slow_request seconds have their
+        slowest statements logged.
+        """
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.slow_request = slow_request
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, duration, stats, tenant=None):
+        """Add one request to a route's totals, given how many seconds it took and its RequestStats.
+
+        tenant is the name of the tenant the request was for, if any.
+        """
+        with self._lock:
+            route_metrics = self._routes.get((tenant or "", route))
+            if route_metrics is None:
+                route_metrics = self._routes[tenant or "", route] = _RouteMetrics(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    route_metrics.buckets[i] += 1
+                    break
+            route_metrics.count += 1
+            route_metrics.duration += duration
+            route_metrics.statements += stats.statements
+            route_metrics.commits += stats.commits
+            route_metrics.connections += stats.connections
+            route_metrics.sql_time += stats.sql_time
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._routes.clear()
+
+    def render(self, tenant=None):
+        """Return the metrics in Prometheus' text exposition format.
+
+        If a tenant is named, only the metrics of that tenant's requests
+        are included, so that tenants can't see one another's.
+        """
+        with self._lock:
+            routes = sorted(item for item in self._routes.items() if tenant is None or item[0][0] == tenant)
+            lines = ["# HELP garden_request_duration_seconds Time taken to answer requests.",
+                     "# TYPE garden_request_duration_seconds histogram"]
+            for (tenant, route), route_metrics in routes:
+                labels = _labels(tenant, route)
+                cumulative = 0
+                for bound, count in zip(self.buckets, route_metrics.buckets):
+                    cumulative += count
+                    lines.append('garden_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                        labels, bound, cumulative))
+                lines.append('garden_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(
+                    labels, route_metrics.count))
+                lines.append('garden_request_duration_seconds_sum{{{}}} {}'.format(labels, route_metrics.duration))
+                lines.append('garden_request_duration_seconds_count{{{}}} {}'.format(labels, route_metrics.count))
+            for name, attribute, description in (
+                    ("garden_sql_statements_total", "statements", "SQL statements executed."),
+                    ("garden_sql_seconds_total", "sql_time", "Time spent executing SQL and committing."),
+                    ("garden_db_commits_total", "commits", "Transactions committed."),
+                    ("garden_db_connections_opened_total", "connections", "Database connections opened.")):
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} counter".format(name))
+                for (tenant, route), route_metrics in routes:
+                    lines.append('{}{{{}}} {}'.format(name, _labels(tenant, route),
+                                                      getattr(route_metrics, attribute)))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(tenant, route):
+    """Return the labels of a tenant's route, leaving out the tenant if there isn't one."""
+    labels = 'route="{}"'.format(_label(route))
+    return 'tenant="{}",{}'.format(_label(tenant), labels) if tenant else labels
+
+
+def _label(value):
+    """Escape a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
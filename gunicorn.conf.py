@@ -0,0 +1,34 @@
+"""Production serving with gunicorn: gunicorn -c gunicorn.conf.py
+
+Runs several worker processes on one database file, so the database is
+put in WAL mode with synchronous=NORMAL, where readers never wait for
+writers, and writes queue up one at a time for the writer lock. Each
+setting can still be overridden from the environment. Set
+GARDEN_DB_IN_MEMORY=1 to serve reads from an in-memory copy of the
+database in each worker instead, which pays off when writes are rare (see
+benchmarks.serving). To serve several businesses, each from a database
+of its own at a subdomain of its own, set GARDEN_DB_TENANT_DIRECTORY
+and create their databases with "flask garden add-tenant NAME".
+"""
+import multiprocessing
+import os
+
+os.environ.setdefault("GARDEN_DB_JOURNAL_MODE", "wal")
+os.environ.setdefault("GARDEN_DB_SYNCHRONOUS", "normal")
+os.environ.setdefault("GARDEN_DB_BUSY_TIMEOUT", "10")
+os.environ.setdefault("GARDEN_DB_SINGLE_WRITER", "1")
+
+wsgi_app = "app:app"
+bind = os.environ.get("GARDEN_BIND", "0.0.0.0:443")
+certfile = "server.crt"
+keyfile = "server.key"
+workers = int(os.environ.get("GARDEN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GARDEN_THREADS", "4"))
+
+
+def on_starting(server):
+    """Migrate the databases and switch them to WAL mode once, before any worker starts."""
+    import dbc
+    dbc.migrate()
+    for tenant in dbc.tenants():
+        dbc.migrate(dbc.tenant_database(tenant))
@@ -1,13 +1,37 @@
-from datetime import datetime as dt
 from werkzeug.exceptions import BadRequest
 
+# The English names of the months, in calendar order. Month n is MONTHS[n - 1].
+MONTHS = ["January", "February", "March", "April", "May", "June", "July",
+          "August", "September", "October", "November", "December"]
 
-def dt_from_month(month):
-    """Converts the name of a month to a sortable datetime object.
+_MONTH_NUMBERS = {name: number for number, name in enumerate(MONTHS, 1)}
 
+
+def month_number(month):
+    """Converts the name of a month to its number, from 1 to 12.
+
+    Numbers that are already valid months are returned unchanged. This
+    is a dictionary lookup, so it is cheap enough to use as a sort key.
     Only works with English months.
     """
-    try:
-        return dt.strptime(month, '%B')
-    except ValueError:
-        raise BadRequest
+    if month in _MONTH_NUMBERS:
+        return _MONTH_NUMBERS[month]
+    if isinstance(month, int) and 1 <= month <= 12:
+        return month
+    raise BadRequest
+
+
+def month_mask(months):
+    """Converts a list of month names or numbers to a 12-bit mask.
+
+    Bit n - 1 of the mask is set if month n is in the list.
+    """
+    mask = 0
+    for month in months:
+        mask |= 1 << (month_number(month) - 1)
+    return mask
+
+
+def months_from_mask(mask):
+    """Converts a 12-bit month mask back to a list of month names in calendar order."""
+    return [name for number, name in enumerate(MONTHS) if mask & (1 << number)]